@@ -0,0 +1,417 @@
+"""
+Load test for the compilation server.
+
+Starts the server with a stand-in for the emscripten toolchain (see
+fake_toolchain/), sends it a mix of requests from a number of concurrent
+clients, and reports the throughput and latency of each kind of request.
+See the "Benchmarking" section of backend/README.md for usage.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Optional
+
+import httpx
+
+BENCHMARKS_DIR = Path(__file__).resolve().parent
+FAKE_TOOLCHAIN_DIR = BENCHMARKS_DIR / "fake_toolchain"
+APP_DIR = BENCHMARKS_DIR.parent / "src" / "app"
+
+PASSCODE = "benchmark"
+
+# each kind of request in the mix:
+# hit - compile a program which is already cached
+# miss - compile a program which has never been seen before
+# duplicate - compile a new program, submitted by several clients at once
+# download - download a file of a cached model
+OPERATIONS = ("hit", "miss", "duplicate", "download")
+DEFAULT_MIX = "hit=40,miss=10,duplicate=5,download=45"
+
+
+@dataclass
+class Results:
+    latencies: dict[str, list[float]] = field(
+        default_factory=lambda: {op: [] for op in OPERATIONS}
+    )
+    errors: dict[str, dict[int, int]] = field(
+        default_factory=lambda: {op: {} for op in OPERATIONS}
+    )
+
+    def record(self, op: str, status: int, seconds: float) -> None:
+        if 200 <= status < 300:
+            self.latencies[op].append(seconds)
+        else:
+            self.errors[op][status] = self.errors[op].get(status, 0) + 1
+
+
+def parse_mix(mix: str) -> dict[str, float]:
+    weights = {}
+    for item in mix.split(","):
+        op, _, weight = item.partition("=")
+        op = op.strip()
+        if op not in OPERATIONS:
+            raise argparse.ArgumentTypeError(
+                f"unknown operation {op!r}, expected one of {', '.join(OPERATIONS)}"
+            )
+        weights[op] = float(weight)
+    return weights
+
+
+def percentile(values: list[float], p: float) -> float:
+    """Nearest-rank percentile of a sorted list."""
+    if not values:
+        return float("nan")
+    rank = max(0, min(len(values) - 1, round(p / 100 * len(values)) - 1))
+    return values[rank]
+
+
+def stan_program(name: str) -> bytes:
+    # the name is used as an identifier so that programs stay distinct
+    # even if the server normalizes comments and whitespace
+    return (
+        f"parameters {{\n  real {name};\n}}\n"
+        f"model {{\n  {name} ~ normal(0, 1);\n}}\n"
+    ).encode()
+
+
+class LoadTest:
+    def __init__(self, client: httpx.AsyncClient, args: argparse.Namespace):
+        self.client = client
+        self.args = args
+        self.results = Results()
+        self.hot_programs: list[bytes] = []
+        self.hot_models: list[str] = []
+        self.rng = random.Random(args.seed)
+        # makes programs unique to this run, even against a long running server
+        self.run_id = uuid.uuid4().hex[:8]
+        self.programs_made = 0
+
+    def _new_program(self) -> bytes:
+        self.programs_made += 1
+        return stan_program(f"x_{self.run_id}_{self.programs_made}")
+
+    async def _compile(self, op: str, program: bytes) -> Optional[str]:
+        before = time.perf_counter()
+        response = await self.client.post(
+            "/compile",
+            content=program,
+            headers={"Authorization": f"Bearer {PASSCODE}"},
+        )
+        self.results.record(op, response.status_code, time.perf_counter() - before)
+        if response.status_code != 200:
+            return None
+        model_id: str = response.json()["model_id"]
+        return model_id
+
+    async def _download(self) -> None:
+        model_id = self.rng.choice(self.hot_models)
+        filename = self.rng.choice(("main.js", "main.wasm"))
+        before = time.perf_counter()
+        response = await self.client.get(
+            f"/download/{model_id}/{filename}",
+            headers={"Accept-Encoding": self.args.accept_encoding},
+        )
+        self.results.record(
+            "download", response.status_code, time.perf_counter() - before
+        )
+
+    async def prepare(self) -> None:
+        """Compiles the programs used for cache hits and downloads."""
+        self.hot_programs = [
+            stan_program(f"hot_{self.run_id}_{i}") for i in range(self.args.hot_models)
+        ]
+        model_ids = await asyncio.gather(
+            *(self._compile("miss", program) for program in self.hot_programs)
+        )
+        self.hot_models = [model_id for model_id in model_ids if model_id]
+        if len(self.hot_models) != len(self.hot_programs):
+            sys.exit("Failed to compile the models used for cache hits")
+        # only the measured requests count
+        self.results = Results()
+
+    async def _run_operation(self, op: str) -> None:
+        if op == "hit":
+            await self._compile(op, self.rng.choice(self.hot_programs))
+        elif op == "miss":
+            await self._compile(op, self._new_program())
+        elif op == "duplicate":
+            program = self._new_program()
+            await asyncio.gather(
+                *(self._compile(op, program) for _ in range(self.args.duplicates))
+            )
+        elif op == "download":
+            await self._download()
+
+    async def _client_loop(self, operations: list[str]) -> None:
+        while operations:
+            await self._run_operation(operations.pop())
+
+    async def run(self, mix: dict[str, float]) -> float:
+        ops, weights = zip(*mix.items())
+        operations = self.rng.choices(ops, weights=weights, k=self.args.requests)
+        before = time.perf_counter()
+        await asyncio.gather(
+            *(self._client_loop(operations) for _ in range(self.args.concurrency))
+        )
+        return time.perf_counter() - before
+
+
+def start_server(args: argparse.Namespace, work_dir: Path) -> subprocess.Popen[bytes]:
+    # tinystan is only used for its bin/stanc and as the build directory,
+    # the rest is just enough for the server to accept it as an installation
+    tinystan_dir = work_dir / "tinystan"
+    (tinystan_dir / "bin").mkdir(parents=True, exist_ok=True)
+    (tinystan_dir / "stan").mkdir(exist_ok=True)
+    (tinystan_dir / "Makefile").touch()
+    shutil.copy(FAKE_TOOLCHAIN_DIR / "stanc", tinystan_dir / "bin" / "stanc")
+    metrics_dir = work_dir / "metrics"
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    metrics_dir.mkdir()
+
+    env = {
+        **os.environ,
+        "PATH": f"{FAKE_TOOLCHAIN_DIR}{os.pathsep}{os.environ['PATH']}",
+        "TINYSTAN_DIR": str(tinystan_dir),
+        "SWS_PASSCODE": PASSCODE,
+        "SWS_JOB_DIR": str(work_dir / "jobs"),
+        "SWS_BUILT_MODEL_DIR": str(work_dir / "compiled_models"),
+        "SWS_LOG_LEVEL": "WARNING",
+        "PROMETHEUS_MULTIPROC_DIR": str(metrics_dir),
+        "FAKE_COMPILE_SECONDS": str(args.compile_seconds),
+        "FAKE_STANC_SECONDS": str(args.stanc_seconds),
+        "FAKE_WASM_BYTES": str(args.wasm_bytes),
+    }
+    if args.max_concurrent_compilations is not None:
+        env["SWS_MAX_CONCURRENT_COMPILATIONS"] = str(args.max_concurrent_compilations)
+
+    log = (work_dir / "server.log").open("wb")
+    return subprocess.Popen(
+        [
+            sys.executable,
+            "-m",
+            "uvicorn",
+            "--app-dir",
+            str(APP_DIR),
+            "main:app",
+            "--port",
+            str(args.port),
+            "--workers",
+            str(args.workers),
+        ],
+        env=env,
+        stdout=log,
+        stderr=subprocess.STDOUT,
+    )
+
+
+async def wait_for_server(
+    client: httpx.AsyncClient,
+    server: Optional[subprocess.Popen[bytes]],
+    timeout: float = 60,
+) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server is not None and server.poll() is not None:
+            sys.exit("Server failed to start, see server.log in its --work-dir")
+        try:
+            if (await client.get("/probe")).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.2)
+    sys.exit(f"Server did not start within {timeout} seconds")
+
+
+async def count_builds(client: httpx.AsyncClient) -> Optional[float]:
+    """Number of compilations run by the server, from its /metrics endpoint."""
+    response = await client.get("/metrics")
+    if response.status_code != 200:
+        return None
+    total = 0.0
+    for line in response.text.splitlines():
+        if line.startswith("sws_compilations_total{"):
+            total += float(line.rsplit(" ", 1)[1])
+    return total
+
+
+def report(
+    results: Results, elapsed: float, builds: Optional[float]
+) -> dict[str, object]:
+    operations: dict[str, object] = {}
+    total = 0
+    print(
+        f"{'operation':<10} {'requests':>9} {'errors':>7} {'req/s':>8} "
+        f"{'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}"
+    )
+    for op in OPERATIONS:
+        latencies = sorted(results.latencies[op])
+        errors = sum(results.errors[op].values())
+        requests = len(latencies) + errors
+        if not requests:
+            continue
+        total += requests
+        throughput = len(latencies) / elapsed
+        p50, p95, p99 = (percentile(latencies, p) for p in (50, 95, 99))
+        slowest = latencies[-1] if latencies else float("nan")
+        operations[op] = {
+            "requests": requests,
+            "errors": results.errors[op],
+            "throughput": throughput,
+            "p50": p50,
+            "p95": p95,
+            "p99": p99,
+            "max": slowest,
+        }
+        print(
+            f"{op:<10} {requests:>9} {errors:>7} {throughput:>8.1f} "
+            f"{p50 * 1000:>9.1f} {p95 * 1000:>9.1f} "
+            f"{p99 * 1000:>9.1f} {slowest * 1000:>9.1f}"
+        )
+
+    print(f"\n{total} requests in {elapsed:.2f}s ({total / elapsed:.1f} req/s)")
+    if builds is not None:
+        print(f"{builds:.0f} compilations run by the server")
+    for op, statuses in results.errors.items():
+        for status, count in statuses.items():
+            print(f"{op}: {count} responses with status {status}")
+    return {
+        "elapsed_seconds": elapsed,
+        "throughput": total / elapsed,
+        "builds": builds,
+        "operations": operations,
+    }
+
+
+async def main(args: argparse.Namespace) -> None:
+    mix = parse_mix(args.mix)
+    if not args.hot_models and ("hit" in mix or "download" in mix):
+        sys.exit("--hot-models must be at least 1 for cache hits and downloads")
+
+    server = None
+    with tempfile.TemporaryDirectory(prefix="sws-benchmark-") as tmp:
+        if args.url is None:
+            work_dir = Path(args.work_dir or tmp)
+            server = start_server(args, work_dir)
+            url = f"http://127.0.0.1:{args.port}"
+        else:
+            url = args.url
+
+        limits = httpx.Limits(max_connections=args.concurrency * args.duplicates)
+        try:
+            async with httpx.AsyncClient(
+                base_url=url, limits=limits, timeout=args.timeout
+            ) as client:
+                await wait_for_server(client, server)
+                test = LoadTest(client, args)
+                await test.prepare()
+                builds_before = await count_builds(client)
+                elapsed = await test.run(mix)
+                builds_after = await count_builds(client)
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait()
+
+    builds = None
+    if builds_before is not None and builds_after is not None:
+        builds = builds_after - builds_before
+    summary = report(test.results, elapsed, builds)
+    if args.json:
+        summary["arguments"] = vars(args)
+        args.json.write_text(json.dumps(summary, indent=2, default=str))
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "--mix",
+        default=DEFAULT_MIX,
+        help="relative weights of each kind of request: "
+        f"{', '.join(OPERATIONS)} (default: {DEFAULT_MIX})",
+    )
+    parser.add_argument(
+        "--requests",
+        type=int,
+        default=500,
+        help="number of requests to send, each duplicate request counting once",
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=16, help="number of concurrent clients"
+    )
+    parser.add_argument(
+        "--duplicates",
+        type=int,
+        default=8,
+        help="number of identical submissions sent at once by a duplicate request",
+    )
+    parser.add_argument(
+        "--hot-models",
+        type=int,
+        default=10,
+        help="number of models compiled beforehand for cache hits and downloads",
+    )
+    parser.add_argument(
+        "--accept-encoding",
+        default="br, gzip",
+        help="Accept-Encoding header of downloads",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="seed of the request mix")
+    parser.add_argument(
+        "--timeout", type=float, default=600, help="timeout of each request, seconds"
+    )
+    parser.add_argument(
+        "--json", type=Path, help="also write the results as JSON to this file"
+    )
+
+    server = parser.add_argument_group("server")
+    server.add_argument(
+        "--url",
+        help="test an already running server instead of starting one "
+        f"(its passcode must be {PASSCODE!r})",
+    )
+    server.add_argument("--port", type=int, default=8090)
+    server.add_argument("--workers", type=int, default=4)
+    server.add_argument("--max-concurrent-compilations", type=int)
+    server.add_argument(
+        "--work-dir",
+        help="directory for the server's jobs and models "
+        "(default: a temporary directory)",
+    )
+
+    toolchain = parser.add_argument_group("fake toolchain")
+    toolchain.add_argument(
+        "--compile-seconds",
+        type=float,
+        default=1,
+        help="time taken by each fake compilation",
+    )
+    toolchain.add_argument(
+        "--stanc-seconds",
+        type=float,
+        default=0,
+        help="time taken by each fake stanc check",
+    )
+    toolchain.add_argument(
+        "--wasm-bytes",
+        type=int,
+        default=1_000_000,
+        help="size of the fake main.wasm",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(parse_args()))
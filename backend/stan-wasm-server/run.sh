@@ -2,4 +2,16 @@
 
 set -ex
 
+# lets the metrics from all workers be combined, see logic/metrics.py
+export PROMETHEUS_MULTIPROC_DIR=${PROMETHEUS_MULTIPROC_DIR:-/tmp/sws-metrics}
+rm -rf "$PROMETHEUS_MULTIPROC_DIR"
+mkdir -p "$PROMETHEUS_MULTIPROC_DIR"
+
+# optionally keeps the job directories in memory, see README.md
+if [ -n "$SWS_JOB_DIR_TMPFS_SIZE" ]; then
+    JOB_DIR=${SWS_JOB_DIR:-/jobs}
+    mkdir -p "$JOB_DIR"
+    mountpoint -q "$JOB_DIR" || mount -t tmpfs -o size="$SWS_JOB_DIR_TMPFS_SIZE" tmpfs "$JOB_DIR"
+fi
+
 uvicorn --app-dir ./src/app main:app --host 0.0.0.0 --port 8080 --workers 4 --timeout-graceful-shutdown 20
@@ -1,4 +1,5 @@
 import logging
+import os
 from functools import lru_cache
 from pathlib import Path
 from typing import Annotated, Literal, Optional
@@ -8,6 +9,7 @@ from pydantic import (
     BeforeValidator,
     DirectoryPath,
     Field,
+    NonNegativeInt,
     PositiveInt,
     SecretStr,
     field_validator,
@@ -19,6 +21,16 @@ LogLevelStr = Annotated[
 ]
 
 
+def _default_max_concurrent_compilations() -> int:
+    # a compilation keeps roughly one core busy and can use up to ~2 GB of memory
+    cpus = os.cpu_count() or 1
+    try:
+        memory = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (ValueError, OSError):
+        return cpus
+    return max(1, min(cpus, memory // (2 * 1024**3)))
+
+
 class StanWasmServerSettings(BaseSettings):
     model_config = SettingsConfigDict(env_prefix="SWS_")
 
@@ -26,10 +38,35 @@ class StanWasmServerSettings(BaseSettings):
     restart_token: Optional[SecretStr] = None
     job_dir: Path = Path("/jobs")
     built_model_dir: Path = Path("/compiled_models")
+    normalize_program_hash: bool = False
+    cache_max_bytes: Optional[PositiveInt] = None
+    cache_max_models: Optional[PositiveInt] = None
     compilation_timeout: PositiveInt = 60 * 5
+    compilation_cpu_time_limit: Optional[PositiveInt] = None
+    compilation_memory_limit: Optional[PositiveInt] = None
+    compilation_nice: int = Field(default=10, ge=0, le=19)
+    compilation_low_io_priority: bool = True
+    stanc_timeout: PositiveInt = 30
+    failure_cache_ttl: NonNegativeInt = 60 * 60
+    max_concurrent_compilations: PositiveInt = Field(
+        default_factory=_default_max_concurrent_compilations
+    )
+    max_concurrent_checks: PositiveInt = Field(
+        default_factory=lambda: os.cpu_count() or 1
+    )
+    max_queued_compilations: NonNegativeInt = 32
+    busy_retry_after: PositiveInt = 30
+    job_record_retention: PositiveInt = 60 * 60
+    job_sweep_interval: PositiveInt = 60 * 10
     tinystan: DirectoryPath = Field(
         validation_alias=AliasChoices("tinystan", "tinystan_dir")
     )
+    compiler_cache_dir: Optional[Path] = None
+    compiler_cache_max_size: str = "5G"
+    prewarm_dir: Optional[DirectoryPath] = None
+    prewarm_max_programs: PositiveInt = 100
+    artifact_store_url: Optional[str] = None
+    artifact_store_endpoint_url: Optional[str] = None
     log_level_str: LogLevelStr = Field(default="INFO", validation_alias="sws_log_level")
 
     @field_validator("tinystan")
@@ -41,6 +78,15 @@ class StanWasmServerSettings(BaseSettings):
             )
         return v.absolute()
 
+    @field_validator("artifact_store_url")
+    @classmethod
+    def artifact_store_url_is_supported(cls, v: Optional[str]) -> Optional[str]:
+        if v is not None and not v.startswith(("file://", "s3://")):
+            raise ValueError(
+                f"Artifact store URL '{v}' must start with 'file://' or 's3://'."
+            )
+        return v
+
     @property
     def log_level(self) -> int:
         return getattr(logging, self.log_level_str, logging.INFO)
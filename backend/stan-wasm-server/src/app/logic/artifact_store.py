@@ -0,0 +1,219 @@
+import json
+import logging
+import os
+import re
+from abc import ABC, abstractmethod
+from pathlib import Path
+from shutil import copyfile, rmtree
+from typing import Any, Callable, Optional
+from urllib.parse import urlparse
+from uuid import uuid4
+
+try:
+    import boto3
+    from botocore.exceptions import ClientError
+except ImportError:
+    boto3 = None
+
+from .compression import compressed_compilation_outputs
+from .file_validation.compilation_files import COMPILATION_OUTPUTS
+
+logger = logging.getLogger(__name__)
+
+# Model ids are hashes of the program, so a model published by one server
+# is valid for all servers using the same hash salt (see compilation.py).
+# Each model is stored as its files plus a marker listing them, which is
+# written last: a model without a marker is incomplete and is ignored.
+_COMPLETE_MARKER = "complete.json"
+
+_MODEL_ID_PATTERN = re.compile(r"^[0-9a-f]{40}$")
+
+
+def is_valid_model_id(model_id: str) -> bool:
+    return _MODEL_ID_PATTERN.match(model_id) is not None
+
+
+def _files_to_publish(model_dir: Path) -> list[str]:
+    # same order as copy_compiled_files_to_cache, so that the required
+    # outputs are the last to appear when the files are fetched
+    return [
+        file
+        for file in compressed_compilation_outputs() + COMPILATION_OUTPUTS
+        if (model_dir / file).is_file()
+    ]
+
+
+def _install_files(
+    model_dir: Path, files: list[str], download: Callable[[str, Path], object]
+) -> None:
+    """
+    Downloads all the files under temporary names, then moves them into place,
+    so that a failed download leaves nothing behind in the cache.
+    """
+    downloaded = []
+    try:
+        for file in files:
+            tmp = model_dir / f".{file}.{uuid4().hex}.tmp"
+            downloaded.append(tmp)
+            download(file, tmp)
+        for file, tmp in zip(files, downloaded):
+            os.replace(tmp, model_dir / file)
+    finally:
+        for tmp in downloaded:
+            tmp.unlink(missing_ok=True)
+
+
+class ArtifactStore(ABC):
+    """
+    Storage for compiled models shared by several servers.
+
+    Each server keeps its own cache in ``built_model_dir``; the artifact store
+    sits behind it, so a model compiled by any server can be fetched by the
+    others instead of being compiled again.
+    """
+
+    @abstractmethod
+    def contains(self, model_id: str) -> bool:
+        """Returns whether a complete copy of the model is stored."""
+
+    @abstractmethod
+    def fetch(self, model_id: str, model_dir: Path) -> bool:
+        """
+        Copies the files of the model into ``model_dir``.
+        Returns False if the model is not stored.
+        """
+
+    @abstractmethod
+    def publish(self, model_id: str, model_dir: Path) -> None:
+        """Stores the compiled files in ``model_dir``, if not already stored."""
+
+
+class FilesystemArtifactStore(ArtifactStore):
+    """
+    Stores models in a directory, typically on a volume shared by the servers.
+    """
+
+    def __init__(self, root: Path) -> None:
+        self._root = root
+        root.mkdir(parents=True, exist_ok=True)
+
+    def contains(self, model_id: str) -> bool:
+        return (self._root / model_id / _COMPLETE_MARKER).is_file()
+
+    def fetch(self, model_id: str, model_dir: Path) -> bool:
+        source = self._root / model_id
+        try:
+            marker = json.loads((source / _COMPLETE_MARKER).read_text())
+        except FileNotFoundError:
+            return False
+        _install_files(
+            model_dir, marker["files"], lambda file, tmp: copyfile(source / file, tmp)
+        )
+        return True
+
+    def publish(self, model_id: str, model_dir: Path) -> None:
+        dest = self._root / model_id
+        if dest.exists():
+            return
+        # assembled under a temporary name, then renamed into place at once
+        tmp = self._root / f".{model_id}.{uuid4().hex}.tmp"
+        tmp.mkdir()
+        try:
+            files = _files_to_publish(model_dir)
+            for file in files:
+                copyfile(model_dir / file, tmp / file)
+            (tmp / _COMPLETE_MARKER).write_text(json.dumps({"files": files}))
+            os.rename(tmp, dest)
+        except OSError:
+            # another server published the same model first
+            if not dest.exists():
+                raise
+        finally:
+            if tmp.exists():
+                rmtree(tmp)
+
+
+class S3ArtifactStore(ArtifactStore):
+    """
+    Stores models in an S3 compatible object store, under
+    ``{prefix}/{model_id}/``. Credentials are found by boto3 in the usual way,
+    e.g. the ``AWS_ACCESS_KEY_ID`` and ``AWS_SECRET_ACCESS_KEY`` variables.
+    """
+
+    def __init__(self, bucket: str, prefix: str, endpoint_url: Optional[str]) -> None:
+        if boto3 is None:
+            raise RuntimeError("boto3 is required to use an S3 artifact store")
+        self._bucket = bucket
+        self._prefix = prefix.strip("/")
+        self._client: Any = boto3.client("s3", endpoint_url=endpoint_url)
+
+    def _key(self, model_id: str, file: str) -> str:
+        return "/".join(filter(None, (self._prefix, model_id, file)))
+
+    def _read_marker(self, model_id: str) -> Optional[dict[str, Any]]:
+        try:
+            response = self._client.get_object(
+                Bucket=self._bucket, Key=self._key(model_id, _COMPLETE_MARKER)
+            )
+        except ClientError as exc:
+            if exc.response["Error"]["Code"] in ("NoSuchKey", "404"):
+                return None
+            raise
+        marker: dict[str, Any] = json.loads(response["Body"].read())
+        return marker
+
+    def contains(self, model_id: str) -> bool:
+        try:
+            self._client.head_object(
+                Bucket=self._bucket, Key=self._key(model_id, _COMPLETE_MARKER)
+            )
+        except ClientError as exc:
+            if exc.response["Error"]["Code"] in ("NoSuchKey", "404"):
+                return False
+            raise
+        return True
+
+    def fetch(self, model_id: str, model_dir: Path) -> bool:
+        marker = self._read_marker(model_id)
+        if marker is None:
+            return False
+        _install_files(
+            model_dir,
+            marker["files"],
+            lambda file, tmp: self._client.download_file(
+                self._bucket, self._key(model_id, file), str(tmp)
+            ),
+        )
+        return True
+
+    def publish(self, model_id: str, model_dir: Path) -> None:
+        if self.contains(model_id):
+            return
+        # objects are uploaded whole, and identical whichever server
+        # compiled the model, so concurrent uploads are harmless
+        files = _files_to_publish(model_dir)
+        for file in files:
+            self._client.upload_file(
+                str(model_dir / file), self._bucket, self._key(model_id, file)
+            )
+        self._client.put_object(
+            Bucket=self._bucket,
+            Key=self._key(model_id, _COMPLETE_MARKER),
+            Body=json.dumps({"files": files}).encode(),
+        )
+
+
+def create_artifact_store(
+    url: Optional[str], endpoint_url: Optional[str]
+) -> Optional[ArtifactStore]:
+    """
+    Creates the artifact store for a ``file://`` or ``s3://`` URL, if any.
+    """
+    if url is None:
+        return None
+    parsed = urlparse(url)
+    if parsed.scheme == "file":
+        return FilesystemArtifactStore(Path(parsed.path))
+    if parsed.scheme == "s3":
+        return S3ArtifactStore(parsed.netloc, parsed.path, endpoint_url)
+    raise ValueError(f"Unsupported artifact store URL: {url}")
@@ -1,23 +1,73 @@
 import asyncio
 import logging
+import os
+import re
+import shlex
+import signal
 import time
-from functools import lru_cache
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from functools import lru_cache, partial
 from hashlib import sha1
+from io import BytesIO, TextIOWrapper
 from pathlib import Path
 from shutil import copy2
+from typing import Generator, Optional, TextIO
 
+from .artifact_store import ArtifactStore, is_valid_model_id
+from .compilation_job_mgmt import (
+    JOB_OUTPUT_FILE,
+    OutputStream,
+    copy_job_output,
+    release_compilation_job,
+    retain_compilation_job,
+    write_job_output,
+)
+from .compression import compress_compilation_outputs, compressed_compilation_outputs
 from .exceptions import (
     StanPlaygroundCompilationException,
+    StanPlaygroundCompilationInterruptedException,
     StanPlaygroundCompilationTimeoutException,
 )
+from .failure_cache import (
+    get_compilation_failure,
+    get_toolchain_version,
+    record_compilation_failure,
+)
 from .file_validation.compilation_files import (
     COMPILATION_OUTPUTS,
     compilation_files_exist,
 )
 from .locking import compilation_output_lock, wait_until_free
+from .metrics import CACHE_LOOKUPS, COMPILATIONS, timed
+from .model_cache import ModelCache
+from .optimization_profiles import OPTIMIZATION_PROFILES, OptimizationProfile
+from .process_limits import ProcessLimits
+from .scheduling import CompilationScheduler
+from .singleflight import SingleFlight
 
 logger = logging.getLogger(__name__)
 
+# compiler output can contain very long lines (e.g. C++ template errors)
+_OUTPUT_LINE_LIMIT = 1024 * 1024
+
+# compilations currently running in this process, keyed by the hash of
+# their source, which is the model id unless programs are normalized
+_compilations: SingleFlight[None] = SingleFlight()
+
+
+@dataclass
+class _RunningCompilation:
+    # the job directory the compilation runs in, whose output
+    # is copied to the other requests waiting for it
+    job_dir: Path
+    # set when a request which is not low priority waits for a low priority
+    # compilation, which then stops giving way to other compilations
+    priority_raised: asyncio.Event = field(default_factory=asyncio.Event)
+
+
+_running_compilations: dict[str, _RunningCompilation] = {}
+
 
 @lru_cache
 def _get_salt() -> bytes:
@@ -35,15 +85,104 @@ def _get_salt() -> bytes:
     return salt
 
 
-def _compute_stan_program_hash(program_file: Path) -> str:
-    stan_program = program_file.read_text()
+def _normalize_stan_program(stan_program: str) -> str:
+    """
+    Returns a form of the program which is the same for programs that differ
+    only in comments, whitespace, or line endings.
+
+    Programs with a backslash in a string literal are returned unchanged.
+    Line breaks are kept, so line numbers in messages from the compiled model
+    still match any of the programs with the same normal form.
+    """
+    out: list[str] = []
+    text = stan_program.replace("\r\n", "\n").replace("\r", "\n")
+    i, n = 0, len(text)
+    pending_space = False
+    while i < n:
+        c = text[i]
+        if c == "\n":
+            out.append(c)
+            pending_space = False
+            i += 1
+        elif c in " \t\f\v":
+            pending_space = True
+            i += 1
+        elif text.startswith("//", i):
+            end = text.find("\n", i)
+            i = n if end == -1 else end
+        elif text.startswith("/*", i):
+            end = text.find("*/", i + 2)
+            end = n if end == -1 else end + 2
+            out.append("\n" * text.count("\n", i, end))
+            # a comment between two tokens still separates them
+            pending_space = True
+            i = end
+        else:
+            if pending_space and out and out[-1][-1:] != "\n":
+                out.append(" ")
+            pending_space = False
+            if c == '"':
+                # copy string literals verbatim
+                end = i + 1
+                while end < n and text[end] not in '"\n':
+                    if text[end] == "\\":
+                        # be conservative about where the string could end
+                        return stan_program
+                    end += 1
+                end = min(end + 1, n)
+                out.append(text[i:end])
+                i = end
+            else:
+                out.append(c)
+                i += 1
+    return "".join(out).rstrip("\n") + "\n"
+
+
+def _hash_stan_program(
+    stan_program: str, normalize: bool, profile: OptimizationProfile
+) -> str:
+    if normalize:
+        stan_program = _normalize_stan_program(stan_program)
     hasher = sha1(_get_salt())
     hasher.update(stan_program.encode())
+    # the default profile is left out, so that its ids are the same
+    # as before there were profiles
+    if profile != "default":
+        hasher.update(f"\0profile={profile}".encode())
     return hasher.hexdigest()
 
 
-def make_canonical_model_dir(src_file: Path, built_model_dir: Path) -> Path:
-    stan_program_hash = _compute_stan_program_hash(src_file)
+def _compute_stan_program_hash(
+    program_file: Path,
+    normalize: bool = False,
+    profile: OptimizationProfile = "default",
+) -> str:
+    return _hash_stan_program(program_file.read_text(), normalize, profile)
+
+
+def compute_stan_program_hash(
+    stan_program: bytes,
+    normalize: bool = False,
+    profile: OptimizationProfile = "default",
+) -> str:
+    """
+    Returns the model id of a program which has not been written to disk.
+    """
+    # decoded exactly as read_text would, so that the id is the same as
+    # for the program once written to a file
+    text = TextIOWrapper(BytesIO(stan_program)).read()
+    return _hash_stan_program(text, normalize, profile)
+
+
+def make_canonical_model_dir(
+    src_file: Path,
+    built_model_dir: Path,
+    normalize: bool = False,
+    profile: OptimizationProfile = "default",
+) -> Path:
+    stan_program_hash = _compute_stan_program_hash(
+        src_file, normalize=normalize, profile=profile
+    )
     model_dir = built_model_dir / stan_program_hash
     model_dir.mkdir(exist_ok=True, parents=True)
     return model_dir.absolute()
@@ -51,9 +190,13 @@ def make_canonical_model_dir(src_file: Path, built_model_dir: Path) -> Path:
 
 def copy_compiled_files_to_cache(job_dir: Path, model_dir: Path) -> None:
     logger.info("Copying compiled files from %s to %s", job_dir, model_dir)
-    for file in COMPILATION_OUTPUTS:
+    # compressed copies are optional, and go first so that they are
+    # already in place once the required outputs exist in the cache
+    for file in compressed_compilation_outputs() + COMPILATION_OUTPUTS:
         source = job_dir / file
         if not source.exists():
+            if file not in COMPILATION_OUTPUTS:
+                continue
             raise FileNotFoundError(f"Missing compilation output {file}")
 
         dest = model_dir / file
@@ -65,40 +208,320 @@ def copy_compiled_files_to_cache(job_dir: Path, model_dir: Path) -> None:
         copy2(job_dir / file, model_dir / file)
 
 
+async def find_cached_model(model_dir: Path, cache: ModelCache) -> bool:
+    """
+    Returns whether the model is in the cache, recording the cache hit if so.
+
+    Models this worker has already seen in the cache are found
+    without accessing the filesystem.
+    """
+    if cache.is_complete(model_dir.name):
+        hit = True
+    elif compilation_files_exist(model_dir):
+        # make sure any copying is already complete
+        with timed("lock_wait"):
+            await wait_until_free(model_dir)
+        # the lock may also have been held to evict the model, so check again
+        hit = compilation_files_exist(model_dir)
+        if hit:
+            cache.mark_complete(model_dir.name)
+    else:
+        hit = False
+
+    if hit:
+        logger.info("Cache hit for %s", model_dir)
+        CACHE_LOOKUPS.labels("hit").inc()
+        await cache.record_access(model_dir.name, hit=True)
+    return hit
+
+
 async def compile_and_cache(
-    *, src_file: Path, model_dir: Path, tinystan_dir: Path, timeout: int
+    *,
+    src_file: Path,
+    model_dir: Path,
+    tinystan_dir: Path,
+    timeout: int,
+    scheduler: CompilationScheduler,
+    cache: ModelCache,
+    failure_ttl: int,
+    stanc_timeout: int,
+    compiler_env: dict[str, str],
+    store: Optional[ArtifactStore] = None,
+    limits: ProcessLimits = ProcessLimits(),
+    profile: OptimizationProfile = "default",
+    low_priority: bool = False,
 ) -> None:
-    if compilation_files_exist(model_dir):
-        # if there's a cache hit, make sure any copying is already complete,
-        # then return without compiling
-        await wait_until_free(model_dir)
-        logger.info("Cache hit for %s: %s", src_file, model_dir)
+    if await find_cached_model(model_dir, cache):
         return
 
-    # otherwise, compile in our job-specific folder
-    await compile_stan_program(
-        src_file=src_file, tinystan_dir=tinystan_dir, timeout=timeout
+    # the model id may be shared by programs which differ in comments and
+    # whitespace, and so in their error messages, which quote the source;
+    # failures and shared builds are only reused for the very same program
+    source = _compute_stan_program_hash(src_file, normalize=False, profile=profile)
+
+    # programs which recently failed to compile will fail the same way again
+    if failure_ttl > 0:
+        toolchain = get_toolchain_version(tinystan_dir)
+        failure = get_compilation_failure(model_dir, source, toolchain, failure_ttl)
+        if failure is not None:
+            logger.info("Cached failure for %s: %s", src_file, model_dir)
+            CACHE_LOOKUPS.labels("failure").inc()
+            raise StanPlaygroundCompilationException(failure)
+
+    CACHE_LOOKUPS.labels("miss").inc()
+
+    # identical programs submitted at the same time share one build,
+    # including its failure if the compilation does not succeed
+    key = source
+    build = partial(
+        _compile_and_publish,
+        src_file=src_file,
+        model_dir=model_dir,
+        tinystan_dir=tinystan_dir,
+        timeout=timeout,
+        scheduler=scheduler,
+        cache=cache,
+        failure_ttl=failure_ttl,
+        source=source,
+        stanc_timeout=stanc_timeout,
+        compiler_env=compiler_env,
+        store=store,
+        limits=limits,
+        profile=profile,
+        low_priority=low_priority,
     )
+    if not _compilations.is_running(key):
+        running = _RunningCompilation(job_dir=src_file.parent)
+        _running_compilations[key] = running
+        try:
+            await _compilations.run(
+                key, partial(build, priority_raised=running.priority_raised)
+            )
+        finally:
+            _forget_running_compilation(key, running)
+        return
 
-    # then, try to copy into the cache
-    with compilation_output_lock(model_dir) as exclusive:
-        # if we succeed in getting the lock, it means
-        # EITHER we were the first to compile the model (and need to copy),
-        # OR a compilation finished and released its lock while
-        # we were compiling (and we don't need to copy).
-        if exclusive:
-            if not compilation_files_exist(model_dir):
-                copy_compiled_files_to_cache(src_file.parent, model_dir)
-        # if we failed in getting the lock, it means
-        # another thread is currently copying, and we wait for them.
-        # We do not need to copy, because their version will be
-        # equivalent; we wasted some time, but that's ultimately okay
-        else:
-            await wait_until_free(model_dir)
+    running = _running_compilations[key]
+    if not low_priority:
+        running.priority_raised.set()
+    with (src_file.parent / JOB_OUTPUT_FILE).open("a") as log:
+        write_job_output(
+            log, "stdout", "Waiting for an identical compilation in progress"
+        )
+        # the output of the shared build so far, and as it continues
+        done = asyncio.Event()
+        copying = asyncio.create_task(copy_job_output(running.job_dir, log, done))
+        try:
+            with timed("shared_build"):
+                await _compilations.run(key, build)
+        finally:
+            done.set()
+            await copying
+            _forget_running_compilation(key, running)
 
 
-async def compile_stan_program(
+def _forget_running_compilation(key: str, running: _RunningCompilation) -> None:
+    # the build may go on without the request which left, or a new
+    # build may already have started
+    if not _compilations.is_running(key) and _running_compilations.get(key) is running:
+        del _running_compilations[key]
+
+
+async def _compile_and_publish(
+    *,
+    src_file: Path,
+    model_dir: Path,
+    tinystan_dir: Path,
+    timeout: int,
+    scheduler: CompilationScheduler,
+    cache: ModelCache,
+    failure_ttl: int,
+    source: str,
+    stanc_timeout: int,
+    compiler_env: dict[str, str],
+    store: Optional[ArtifactStore] = None,
+    limits: ProcessLimits = ProcessLimits(),
+    profile: OptimizationProfile = "default",
+    low_priority: bool = False,
+    priority_raised: Optional[asyncio.Event] = None,
+) -> None:
+    # the build runs in the job directory of the request which started it,
+    # which must outlive that request if it goes away while others wait
+    job_dir = src_file.parent
+    retain_compilation_job(job_dir)
+    try:
+        # another server may already have compiled this model
+        if store is not None and await fetch_from_artifact_store(
+            model_dir=model_dir, store=store, cache=cache
+        ):
+            logger.info("Fetched %s from the artifact store", model_dir.name)
+            CACHE_LOOKUPS.labels("remote_hit").inc()
+            await cache.evict(keep=model_dir.name)
+            return
+
+        try:
+            # stanc alone finds most errors in seconds, so check with it
+            # before waiting for capacity to do the full build
+            async with scheduler.check_slot(low_priority, priority_raised):
+                with timed("check"):
+                    await check_stan_program(
+                        src_file=src_file,
+                        tinystan_dir=tinystan_dir,
+                        timeout=stanc_timeout,
+                    )
+            # compile in our job-specific folder, once there is capacity to do so
+            async with scheduler.slot(low_priority, priority_raised):
+                with timed("compile"):
+                    await compile_stan_program(
+                        src_file=src_file,
+                        tinystan_dir=tinystan_dir,
+                        timeout=timeout,
+                        env=compiler_env,
+                        limits=limits,
+                        make_args=OPTIMIZATION_PROFILES[profile],
+                    )
+        except StanPlaygroundCompilationInterruptedException:
+            # like timeouts, these can be caused by load rather than by the
+            # program itself, so they are not recorded
+            raise
+        except StanPlaygroundCompilationException as exc:
+            # timeouts are a different exception and are not recorded either
+            if failure_ttl > 0:
+                record_compilation_failure(
+                    model_dir, str(exc), source, get_toolchain_version(tinystan_dir)
+                )
+            raise
+
+        # compressing once here saves doing it for every download, and is done
+        # after leaving the slot so the next compilation can start meanwhile
+        with timed("compress"):
+            await asyncio.to_thread(compress_compilation_outputs, src_file.parent)
+
+        # then, try to copy into the cache
+        with compilation_output_lock(model_dir) as exclusive:
+            # if we succeed in getting the lock, it means
+            # EITHER we were the first to compile the model (and need to copy),
+            # OR a compilation finished and released its lock while
+            # we were compiling (and we don't need to copy).
+            if exclusive:
+                if not compilation_files_exist(model_dir):
+                    with timed("publish"):
+                        copy_compiled_files_to_cache(src_file.parent, model_dir)
+                        await cache.record_published(model_dir)
+            # if we failed in getting the lock, it means
+            # another thread is currently copying, and we wait for them.
+            # We do not need to copy, because their version will be
+            # equivalent; we wasted some time, but that's ultimately okay
+            else:
+                with timed("lock_wait"):
+                    await wait_until_free(model_dir)
+
+        if store is not None:
+            try:
+                with timed("store_publish"):
+                    await asyncio.to_thread(
+                        store.publish, model_dir.name, src_file.parent
+                    )
+            except Exception:
+                logger.exception(
+                    "Failed to publish %s to the artifact store", model_dir
+                )
+
+        await cache.evict(keep=model_dir.name)
+
+    finally:
+        release_compilation_job(job_dir)
+
+
+async def fetch_from_artifact_store(
+    *, model_dir: Path, store: ArtifactStore, cache: ModelCache
+) -> bool:
+    """
+    Copies a model compiled by another server from the artifact store
+    into the cache. Returns whether the model is now in the cache.
+    """
+    model_id = model_dir.name
+    if not is_valid_model_id(model_id):
+        return False
+    try:
+        if not model_dir.is_dir():
+            # only create directories in the cache for models which exist
+            if not await asyncio.to_thread(store.contains, model_id):
+                return False
+            model_dir.mkdir(exist_ok=True)
+
+        with compilation_output_lock(model_dir) as exclusive:
+            if not exclusive:
+                with timed("lock_wait"):
+                    await wait_until_free(model_dir)
+                return compilation_files_exist(model_dir)
+            if compilation_files_exist(model_dir):
+                return True
+            with timed("fetch"):
+                found = await asyncio.to_thread(store.fetch, model_id, model_dir)
+    except Exception:
+        # the artifact store only saves work, so a model which cannot
+        # be fetched from it is treated like one which is not there
+        logger.exception("Failed to fetch %s from the artifact store", model_id)
+        return False
+
+    if found:
+        await cache.record_published(model_dir)
+    return found
+
+
+async def check_stan_program(
     *, src_file: Path, tinystan_dir: Path, timeout: int
+) -> None:
+    """
+    Checks the Stan program for errors by running stanc alone, without
+    building the C++ it produces
+
+    Args:
+        src_file: Stan file to be checked
+        tinystan_dir: Location of the tinystan installation (with compilation tools)
+        timeout: Maximum number of seconds to allow the check to take
+    """
+    stanc = tinystan_dir / "bin" / "stanc"
+    if not stanc.is_file():
+        logger.warning("No stanc found at %s, skipping check", stanc)
+        return
+
+    logger.info("Checking %s", src_file)
+    process = await asyncio.create_subprocess_exec(
+        stanc,
+        "--filename-in-msg=main.stan",
+        "--o=/dev/null",
+        src_file,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        limit=_OUTPUT_LINE_LIMIT,
+        start_new_session=True,
+    )
+    with _stopped_on_error(process):
+        with (src_file.parent / JOB_OUTPUT_FILE).open("a") as log:
+            try:
+                _, stderr = await _record_until_exit(process, log, timeout)
+            except (asyncio.TimeoutError, TimeoutError):
+                raise StanPlaygroundCompilationTimeoutException()
+
+    if process.returncode != 0:
+        logger.info("Check failed:\n%s", stderr)
+        if _was_interrupted(process.returncode, ""):
+            raise StanPlaygroundCompilationInterruptedException(
+                f"Failed to compile model: {stderr}"
+            )
+        raise StanPlaygroundCompilationException(f"Failed to compile model: {stderr}")
+
+
+async def compile_stan_program(
+    *,
+    src_file: Path,
+    tinystan_dir: Path,
+    timeout: int,
+    env: Optional[dict[str, str]] = None,
+    limits: ProcessLimits = ProcessLimits(),
+    make_args: Optional[list[str]] = None,
 ) -> None:
     """
     Compiles the Stan program in the job directory
@@ -107,29 +530,124 @@ async def compile_stan_program(
         src_file: Stan file to be compiled
         tinystan_dir: Location of the tinystan installation (with compilation tools)
         timeout: Maximum number of seconds to allow compilation to take
+        env: Additional environment variables for the build
+        limits: Resource limits for the processes of the build
+        make_args: Additional arguments for make, such as variables to override
     """
-    try:
-        cmd = f"emmake make STANCFLAGS=--filename-in-msg=main.stan {src_file.with_suffix('.js')} \
-            && emstrip {src_file.with_suffix('.wasm')}"
-        logger.info("Compiling in %s", src_file.parent)
-        before = time.time()
-        process = await asyncio.create_subprocess_shell(
-            cmd,
-            cwd=tinystan_dir,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-        )
-        stdout, stderr = await asyncio.wait_for(process.communicate(), timeout=timeout)
-        logger.info("Compilation finished after %.2f seconds", time.time() - before)
-    except (asyncio.TimeoutError, TimeoutError):
-        raise StanPlaygroundCompilationTimeoutException()
+    args = " ".join(shlex.quote(arg) for arg in make_args or [])
+    cmd = f"{limits.shell_prefix()}emmake make STANCFLAGS=--filename-in-msg=main.stan {args} {src_file.with_suffix('.js')} \
+        && emstrip {src_file.with_suffix('.wasm')}"
+    logger.info("Compiling in %s", src_file.parent)
+    before = time.time()
+    process = await asyncio.create_subprocess_shell(
+        cmd,
+        cwd=tinystan_dir,
+        env={**os.environ, **env} if env else None,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+        limit=_OUTPUT_LINE_LIMIT,
+        # in a process group of its own, so that the build can be stopped
+        # along with everything it started (see _stopped_on_error)
+        start_new_session=True,
+    )
+
+    # output is recorded line by line as it arrives so it can be followed
+    # while the build runs, see follow_job_output
+    with _stopped_on_error(process):
+        with (src_file.parent / JOB_OUTPUT_FILE).open("a") as log:
+            try:
+                stdout, stderr = await _record_until_exit(process, log, timeout)
+                logger.info(
+                    "Compilation finished after %.2f seconds", time.time() - before
+                )
+            except (asyncio.TimeoutError, TimeoutError):
+                COMPILATIONS.labels("timeout").inc()
+                raise StanPlaygroundCompilationTimeoutException()
 
     if process.returncode != 0:
         logger.error(
             "Compilation failed:\nstdout:\n%s\nstderr:\n%s",
-            stdout.decode("utf-8"),
-            stderr.decode("utf-8"),
-        )
-        raise StanPlaygroundCompilationException(
-            f"Failed to compile model: {stderr.decode('utf-8')}"
+            stdout,
+            stderr,
         )
+        if _was_interrupted(process.returncode, stderr):
+            COMPILATIONS.labels("interrupted").inc()
+            raise StanPlaygroundCompilationInterruptedException(
+                f"Failed to compile model: {stderr}"
+            )
+        COMPILATIONS.labels("error").inc()
+        raise StanPlaygroundCompilationException(f"Failed to compile model: {stderr}")
+    COMPILATIONS.labels("success").inc()
+
+
+# What make, the shell, and the compilers report when a process of the build
+# was killed by a signal (by the OOM killer, or for exceeding its CPU time
+# limit) or ran out of memory, disk space, or file descriptors
+_INTERRUPTED_BUILD_PATTERN = re.compile(
+    r"\bError 1(29|[3-9][0-9])\b|\bKilled\b|\bTerminated\b|limit exceeded"
+    r"|No space left on device|Disk quota exceeded|Too many open files"
+    r"|Cannot allocate memory|out of memory|bad_alloc"
+)
+
+
+def _was_interrupted(returncode: Optional[int], stderr: str) -> bool:
+    """
+    Returns whether a failed process was stopped by something other than an
+    error in the program, and so might succeed if run again.
+    """
+    # negative if the process itself was killed by a signal, and over 128 if
+    # the shell reports that the last command it ran was
+    if returncode is not None and (returncode < 0 or returncode > 128):
+        return True
+    return _INTERRUPTED_BUILD_PATTERN.search(stderr) is not None
+
+
+@contextmanager
+def _stopped_on_error(
+    process: asyncio.subprocess.Process,
+) -> Generator[None, None, None]:
+    """
+    Kills the process and every process it started if the block is left with
+    an exception, including timeouts and cancellation of the request.
+    The process must have been started in a new session.
+    """
+    try:
+        yield
+    except BaseException:
+        if process.returncode is None:
+            logger.info("Stopping process group %d", process.pid)
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        raise
+
+
+async def _record_until_exit(
+    process: asyncio.subprocess.Process, log: TextIO, timeout: int
+) -> tuple[str, str]:
+    """
+    Records the output of the process until it exits, and returns its
+    stdout and stderr. Raises TimeoutError after ``timeout`` seconds.
+    """
+    assert process.stdout is not None and process.stderr is not None
+    # unlike gather, a task group waits for its tasks to finish when it is
+    # cancelled or times out, so none is left behind with an exception
+    # which is never retrieved
+    async with asyncio.timeout(timeout):
+        async with asyncio.TaskGroup() as tasks:
+            stdout = tasks.create_task(_record_output(process.stdout, "stdout", log))
+            stderr = tasks.create_task(_record_output(process.stderr, "stderr", log))
+            tasks.create_task(process.wait())
+    return stdout.result(), stderr.result()
+
+
+async def _record_output(
+    stream: asyncio.StreamReader, name: OutputStream, log: TextIO
+) -> str:
+    lines = []
+    async for raw_line in stream:
+        line = raw_line.decode("utf-8", errors="replace")
+        write_job_output(log, name, line.rstrip("\r\n"))
+        lines.append(line)
+    return "".join(lines)
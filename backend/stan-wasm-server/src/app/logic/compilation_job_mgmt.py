@@ -1,30 +1,261 @@
+import asyncio
+import fcntl
+import json
 import logging
+import os
+import re
+import time
+from contextlib import contextmanager, suppress
+from dataclasses import dataclass
 from pathlib import Path
 from shutil import rmtree
+from typing import Any, AsyncIterator, BinaryIO, Generator, Iterator, Literal, TextIO
 from uuid import uuid4
 
 from .file_validation.compilation_files import write_stan_code_file
 
 logger = logging.getLogger(__name__)
 
+# files kept in the job directory to report on asynchronous jobs
+JOB_STATUS_FILE = "status.json"
+JOB_OUTPUT_FILE = "output.jsonl"
+
+# held locked by the worker using a job directory, see sweep_compilation_jobs
+_JOB_LOCK_FILE = ".job.lock"
+
+JobStatus = Literal["pending", "completed", "failed", "busy"]
+OutputStream = Literal["stdout", "stderr"]
+
+_JOB_ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+
+# How often streamed output checks for new lines
+_OUTPUT_POLL_INTERVAL = 0.25
+
+# Job directories younger than this are never swept, since their
+# worker may not have locked them yet
+_SWEEP_MIN_AGE = 60
+
+
+@dataclass
+class _OpenJob:
+    lock_fd: int
+    references: int = 1
+
+
+# Job directories in use by this worker, by job id. A job directory can be
+# used by more than the request which created it (for instance, by a build
+# shared with identical requests), so it is deleted when the last of its
+# users releases it.
+_open_jobs: dict[str, _OpenJob] = {}
+
 
 def create_compilation_job(base_dir: Path) -> Path:
+    """
+    Creates a job directory, which must be released with
+    release_compilation_job once it is no longer needed.
+    """
     job_id = _create_compilation_job_id()
     job_dir = base_dir / job_id
     job_dir.mkdir(parents=True)
 
+    # the lock is held until the directory is deleted, and released by the
+    # OS if the worker dies first, which lets other workers sweep it
+    fd = os.open(job_dir / _JOB_LOCK_FILE, os.O_RDWR | os.O_CREAT, 0o644)
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    _open_jobs[job_id] = _OpenJob(lock_fd=fd)
+
     return job_dir
 
 
+@contextmanager
+def compilation_job(base_dir: Path) -> Generator[Path, None, None]:
+    """
+    Context manager for a job directory used only within the block.
+    """
+    job_dir = create_compilation_job(base_dir)
+    try:
+        yield job_dir
+    finally:
+        release_compilation_job(job_dir)
+
+
+def retain_compilation_job(job_dir: Path) -> None:
+    """
+    Keeps the job directory from being deleted until it is released again.
+    """
+    _open_jobs[job_dir.name].references += 1
+
+
+def release_compilation_job(job_dir: Path) -> None:
+    """
+    Deletes the job directory if nothing else is using it.
+    """
+    job = _open_jobs[job_dir.name]
+    job.references -= 1
+    if job.references:
+        return
+    del _open_jobs[job_dir.name]
+    try:
+        delete_compilation_job(job_dir)
+    finally:
+        os.close(job.lock_fd)
+
+
 def _create_compilation_job_id() -> str:
     return uuid4().hex
 
 
+def get_compilation_job_dir(base_dir: Path, job_id: str) -> Path:
+    if not _JOB_ID_PATTERN.match(job_id):
+        raise FileNotFoundError(f"Job not found: {job_id}")
+    job_dir = base_dir / job_id
+    if not job_dir.is_dir():
+        raise FileNotFoundError(f"Job not found: {job_id}")
+    return job_dir
+
+
 def delete_compilation_job(job_dir: Path) -> None:
     logger.info("Deleting %s", job_dir.absolute())
     rmtree(job_dir)
 
 
+def sweep_compilation_jobs(base_dir: Path) -> int:
+    """
+    Deletes the job directories left behind by workers which stopped
+    without cleaning up, such as after a crash or a restart.
+    Returns the number of directories deleted.
+
+    Directories still locked by a worker are in use and are left alone,
+    as is everything in ``base_dir`` which is not a job directory.
+    """
+    if not base_dir.is_dir():
+        return 0
+    # one sweep at a time, so that sweeps do not trip over each other
+    sweep_fd = os.open(base_dir / ".sweep.lock", os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        try:
+            fcntl.flock(sweep_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return 0
+        return _sweep_unlocked_jobs(base_dir)
+    finally:
+        os.close(sweep_fd)
+
+
+def _sweep_unlocked_jobs(base_dir: Path) -> int:
+    swept = 0
+    for job_dir in base_dir.iterdir():
+        if not _JOB_ID_PATTERN.match(job_dir.name) or job_dir.name in _open_jobs:
+            continue
+        try:
+            if time.time() - job_dir.stat().st_mtime < _SWEEP_MIN_AGE:
+                continue
+            fd = os.open(job_dir / _JOB_LOCK_FILE, os.O_RDWR | os.O_CREAT, 0o644)
+        except FileNotFoundError:
+            # deleted in the meantime
+            continue
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue
+            logger.info("Sweeping abandoned job %s", job_dir.name)
+            rmtree(job_dir, ignore_errors=True)
+            swept += 1
+        finally:
+            os.close(fd)
+    return swept
+
+
+def prune_compilation_job(job_dir: Path) -> None:
+    """
+    Removes everything but the status and output records (and the lock)
+    from the job directory.
+    """
+    logger.info("Pruning %s", job_dir.absolute())
+    for entry in job_dir.iterdir():
+        if entry.name in (JOB_STATUS_FILE, JOB_OUTPUT_FILE, _JOB_LOCK_FILE):
+            continue
+        if entry.is_dir():
+            rmtree(entry)
+        else:
+            entry.unlink()
+
+
+def write_job_status(job_dir: Path, status: JobStatus, **details: Any) -> None:
+    # written to a temporary file and renamed, so readers
+    # in other workers never see a partially written status
+    tmp = job_dir / f".{JOB_STATUS_FILE}.tmp"
+    tmp.write_text(json.dumps({"job_id": job_dir.name, "status": status, **details}))
+    os.replace(tmp, job_dir / JOB_STATUS_FILE)
+
+
+def read_job_status(job_dir: Path) -> dict[str, Any]:
+    status: dict[str, Any] = json.loads((job_dir / JOB_STATUS_FILE).read_text())
+    return status
+
+
+def write_job_output(log: TextIO, stream: OutputStream, line: str) -> None:
+    log.write(json.dumps({"stream": stream, "line": line}) + "\n")
+    log.flush()
+
+
+async def follow_job_output(job_dir: Path) -> AsyncIterator[dict[str, Any]]:
+    """
+    Yields the lines of output of a job as they are written, followed by
+    the final status of the job once it is no longer pending.
+    """
+    output_file = job_dir / JOB_OUTPUT_FILE
+    output_file.touch()
+    with output_file.open("rb") as output:
+        while True:
+            # read the status first, so no output written
+            # before the job finished can be missed
+            status = read_job_status(job_dir)
+            for line in _read_written_lines(output):
+                yield json.loads(line)
+            if status["status"] != "pending":
+                yield status
+                return
+            await asyncio.sleep(_OUTPUT_POLL_INTERVAL)
+
+
+async def copy_job_output(source_dir: Path, log: TextIO, done: asyncio.Event) -> None:
+    """
+    Copies the lines of output of another job into ``log`` as they are written,
+    until ``done`` is set, such as for a request waiting on a build
+    started by another request.
+    """
+    output_file = source_dir / JOB_OUTPUT_FILE
+    try:
+        output_file.touch()
+        output = output_file.open("rb")
+    except FileNotFoundError:
+        # the other job is already over
+        return
+    with output:
+        while True:
+            # checked first, so no output written before
+            # the build finished can be missed
+            finished = done.is_set()
+            for line in _read_written_lines(output):
+                log.write(line.decode())
+            log.flush()
+            if finished:
+                return
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(done.wait(), _OUTPUT_POLL_INTERVAL)
+
+
+def _read_written_lines(output: BinaryIO) -> Iterator[bytes]:
+    while line := output.readline():
+        if not line.endswith(b"\n"):
+            # partially written, try again later
+            output.seek(-len(line), os.SEEK_CUR)
+            return
+        yield line
+
+
 def upload_stan_code_file(job_dir: Path, data: bytes) -> Path:
     file = job_dir / "main.stan"
     write_stan_code_file(file, data)
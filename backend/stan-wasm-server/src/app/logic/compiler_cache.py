@@ -0,0 +1,38 @@
+import logging
+import shutil
+from pathlib import Path
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+def get_compiler_cache_env(
+    cache_dir: Optional[Path], max_size: str, job_base_dir: Path
+) -> dict[str, str]:
+    """
+    Returns the environment variables which make emcc run the compiler
+    through ccache, storing results in ``cache_dir``.
+
+    The cache directory can be shared by all workers (and hosts, if it is
+    on a shared volume); ccache handles concurrent use and its size limit.
+    Returns an empty dict if no cache directory is set or ccache is missing.
+    """
+    if cache_dir is None:
+        return {}
+    ccache = shutil.which("ccache")
+    if ccache is None:
+        logger.warning("ccache not found, compiler cache at %s is disabled", cache_dir)
+        return {}
+
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    return {
+        # see https://emscripten.org/docs/tools_reference/settings_reference.html
+        "EM_COMPILER_WRAPPER": ccache,
+        "CCACHE_DIR": str(cache_dir.absolute()),
+        "CCACHE_MAXSIZE": max_size,
+        # rewrite paths inside job directories to relative ones where possible
+        "CCACHE_BASEDIR": str(job_base_dir.absolute()),
+        "CCACHE_NOHASHDIR": "true",
+        # needed for hits when using the Stan precompiled header (see local.mk)
+        "CCACHE_SLOPPINESS": "pch_defines,time_macros,include_file_mtime,include_file_ctime",
+    }
@@ -10,8 +10,21 @@ class StanPlaygroundCompilationException(Exception):
     """Raise if compilation failed for non-timeout (including unknown) reasons."""
 
 
+class StanPlaygroundCompilationInterruptedException(StanPlaygroundCompilationException):
+    """Raise if compilation failed for reasons other than the program, such as
+    the build being killed or running out of memory or disk space."""
+
+
 class StanPlaygroundCompilationTimeoutException(Exception):
     """Raise if compilation failed due to timeout specifically."""
 
     def __init__(self) -> None:
         super().__init__("Model compilation took too long to complete")
+
+
+class StanPlaygroundServerBusyException(Exception):
+    """Raise if the server is too busy to accept another compilation."""
+
+    def __init__(self, retry_after: int) -> None:
+        super().__init__("Server is busy, please try again later")
+        self.retry_after = retry_after
@@ -0,0 +1,77 @@
+import json
+import logging
+import os
+import time
+from functools import lru_cache
+from hashlib import sha1
+from pathlib import Path
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+def _get_failure_file_name(model_dir: Path, source: str) -> Path:
+    # programs with normalized model ids can share the model directory, but
+    # not their failures, whose messages quote the source and refer to
+    # positions in it
+    if source == model_dir.name:
+        return model_dir / "failure.json"
+    return model_dir / f"failure.{source}.json"
+
+
+@lru_cache
+def get_toolchain_version(tinystan_dir: Path) -> str:
+    """
+    Returns an identifier for the tinystan installation used to compile models,
+    so that failures recorded with an older toolchain are not reused.
+    """
+    hasher = sha1()
+    git_dir = tinystan_dir / ".git"
+    head_file = git_dir / "HEAD"
+    if head_file.is_file():
+        head = head_file.read_text().strip()
+        if head.startswith("ref: "):
+            ref_file = git_dir / head.removeprefix("ref: ")
+            if ref_file.is_file():
+                head = ref_file.read_text().strip()
+        hasher.update(head.encode())
+    local_config = tinystan_dir / "make" / "local"
+    if local_config.is_file():
+        hasher.update(local_config.read_bytes())
+    return hasher.hexdigest()
+
+
+def record_compilation_failure(
+    model_dir: Path, message: str, source: str, toolchain: str
+) -> None:
+    failure_file = _get_failure_file_name(model_dir, source)
+    # the directory may have been swept while the program was compiling
+    model_dir.mkdir(parents=True, exist_ok=True)
+    tmp = failure_file.with_suffix(f".{os.getpid()}.tmp")
+    tmp.write_text(
+        json.dumps({"message": message, "time": time.time(), "toolchain": toolchain})
+    )
+    os.replace(tmp, failure_file)
+
+
+def get_compilation_failure(
+    model_dir: Path, source: str, toolchain: str, ttl: int
+) -> Optional[str]:
+    """
+    Returns the error message of a previous failed compilation of this model,
+    if one was recorded less than ``ttl`` seconds ago with the same toolchain.
+    ``source`` is the hash of the program without normalization.
+    """
+    failure_file = _get_failure_file_name(model_dir, source)
+    try:
+        failure = json.loads(failure_file.read_text())
+    except (FileNotFoundError, ValueError):
+        return None
+
+    if failure["toolchain"] != toolchain or time.time() - failure["time"] > ttl:
+        logger.debug("Discarding outdated compilation failure for %s", model_dir)
+        failure_file.unlink(missing_ok=True)
+        return None
+
+    message: str = failure["message"]
+    return message
@@ -20,7 +20,11 @@ def compilation_files_exist(model_dir: Path) -> bool:
     return all((model_dir / x).exists() for x in COMPILATION_OUTPUTS)
 
 
-def write_stan_code_file(file_location: Path, data: bytes) -> None:
+def validate_stan_code(data: bytes) -> None:
     if not _stan_src_file_is_within_size_limit(data):
         raise StanPlaygroundInvalidFileException("Stan source file too large.")
+
+
+def write_stan_code_file(file_location: Path, data: bytes) -> None:
+    validate_stan_code(data)
     file_location.write_bytes(data)
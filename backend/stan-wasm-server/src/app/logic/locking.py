@@ -1,45 +1,150 @@
 import asyncio
+import fcntl
 import logging
-import threading
+import os
 from contextlib import contextmanager
 from pathlib import Path
 from typing import Generator
 
 logger = logging.getLogger(__name__)
 
+# The lock on a model directory is an advisory flock(2) lock on a file inside it.
+# flock locks belong to an open file description, so they exclude each other
+# both across uvicorn worker processes and between coroutines in the same
+# process. The kernel releases them when the owning process exits, so a
+# crashed worker can never leave a stale lock behind for others to wait on.
+
+
+# How often wait_until_free checks whether the lock has been released, at
+# first and at most: the interval doubles while the lock stays held
+_WAIT_POLL_INTERVAL = 0.01
+_WAIT_MAX_POLL_INTERVAL = 0.5
+
 
 def _get_compilation_lockfile_name(model_dir: Path) -> Path:
-    p = model_dir / "running.txt"
+    p = model_dir / "compilation.lock"
     return p
 
 
-async def wait_until_free(model_dir: Path) -> None:
+def is_lockfile(path: Path) -> bool:
+    return path == _get_compilation_lockfile_name(path.parent)
+
+
+@contextmanager
+def _open_lockfile(model_dir: Path) -> Generator[int, None, None]:
     lockfile = _get_compilation_lockfile_name(model_dir)
-    while lockfile.is_file():
-        await asyncio.sleep(1)
+    fd = os.open(lockfile, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        yield fd
+    finally:
+        # closing the descriptor also releases any lock held through it
+        os.close(fd)
+
+
+def _is_current(fd: int, model_dir: Path) -> bool:
+    """
+    Returns whether the open lockfile is still the one in the model directory.
+    Evicting a model removes its directory, lockfile included, while holding the
+    lock, so a lock acquired on a removed lockfile protects nothing.
+    """
+    try:
+        current = os.stat(_get_compilation_lockfile_name(model_dir))
+    except FileNotFoundError:
+        return False
+    return os.fstat(fd).st_ino == current.st_ino
+
+
+def remove_locked_directory(model_dir: Path) -> None:
+    """
+    Removes the model directory, which must be locked with
+    compilation_output_lock, and everything in it.
+    """
+    for f in model_dir.iterdir():
+        if f.is_file() and not is_lockfile(f):
+            f.unlink()
+    # the lockfile goes last, so that processes waiting on it
+    # see that it is stale once they get the lock
+    _get_compilation_lockfile_name(model_dir).unlink(missing_ok=True)
+    try:
+        model_dir.rmdir()
+    except OSError:
+        # another process has already started using the directory again
+        pass
+
+
+def _try_flock(fd: int, operation: int) -> bool:
+    try:
+        fcntl.flock(fd, operation | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return False
+    return True
+
+
+def _get_lock_owner(fd: int) -> str:
+    try:
+        return os.pread(fd, 32, 0).decode().strip() or "unknown"
+    except OSError:
+        return "unknown"
+
+
+async def wait_until_free(model_dir: Path) -> None:
+    """
+    Waits until no process is holding the lock on the model directory.
+    """
+    while True:
+        try:
+            fd = os.open(_get_compilation_lockfile_name(model_dir), os.O_RDWR)
+        except FileNotFoundError:
+            # no lockfile, so nothing can be holding it
+            return
+        try:
+            if not _try_flock(fd, fcntl.LOCK_SH):
+                logger.debug(
+                    "Waiting for process %s to release lock on %s",
+                    _get_lock_owner(fd),
+                    model_dir,
+                )
+                # polled rather than waited for with a blocking flock in a
+                # thread: the holder of the lock may itself need one of the
+                # default executor's threads before it can release the lock
+                interval = _WAIT_POLL_INTERVAL
+                while not _try_flock(fd, fcntl.LOCK_SH):
+                    await asyncio.sleep(interval)
+                    interval = min(2 * interval, _WAIT_MAX_POLL_INTERVAL)
+            if _is_current(fd, model_dir):
+                return
+            # the directory was removed while we waited, and may be in use again
+        finally:
+            os.close(fd)
 
 
 @contextmanager
 def compilation_output_lock(model_dir: Path) -> Generator[bool, None, None]:
     """
-    Context manager for the lock on the model directory.
+    Context manager for the lock on the model directory, which is
+    created if it does not exist (for instance, after being evicted).
     Yields True if the lock was acquired, False otherwise.
     """
-    lockfile = _get_compilation_lockfile_name(model_dir)
-    try:
-        with lockfile.open(mode="x") as file:
-            file.write("locked")
-    except FileExistsError:
-        logger.debug(
-            "Thread %d failed to acquire lock on %s", threading.get_ident(), model_dir
-        )
-        yield False
-    else:
-        # we have the lock, so we need to clean it up
-        try:
-            logger.debug(
-                "Thread %d acquired lock on %s", threading.get_ident(), model_dir
-            )
+    while True:
+        model_dir.mkdir(parents=True, exist_ok=True)
+        with _open_lockfile(model_dir) as fd:
+            if not _try_flock(fd, fcntl.LOCK_EX):
+                logger.debug(
+                    "Process %d failed to acquire lock on %s (held by process %s)",
+                    os.getpid(),
+                    model_dir,
+                    _get_lock_owner(fd),
+                )
+                yield False
+                return
+            if not _is_current(fd, model_dir):
+                # removed between opening and locking it, so try again
+                continue
+
+            # record the owner to make debugging easier; the lock itself
+            # does not depend on the contents of the file
+            os.ftruncate(fd, 0)
+            os.pwrite(fd, str(os.getpid()).encode(), 0)
+            logger.debug("Process %d acquired lock on %s", os.getpid(), model_dir)
             yield True
-        finally:
-            lockfile.unlink()
+            return
@@ -0,0 +1,97 @@
+import os
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Generator, Optional
+
+from prometheus_client import (
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+# When run with several uvicorn workers, PROMETHEUS_MULTIPROC_DIR must be set
+# (see run.sh) so that the metrics of all workers are combined when scraped.
+
+PHASE_DURATION = Histogram(
+    "sws_phase_duration_seconds",
+    "Time spent in each phase of handling a request",
+    ["phase"],
+    buckets=(0.001, 0.005, 0.025, 0.1, 0.5, 1, 5, 15, 30, 60, 120, 300, 600),
+)
+CACHE_LOOKUPS = Counter(
+    "sws_cache_lookups_total",
+    "Compilation requests by whether the model was already cached",
+    ["result"],
+)
+COMPILATIONS = Counter(
+    "sws_compilations_total",
+    "Compilations run, by outcome",
+    ["outcome"],
+)
+QUEUE_DEPTH = Gauge(
+    "sws_compilation_queue_depth",
+    "Number of compilations waiting for a slot",
+    multiprocess_mode="livesum",
+)
+DOWNLOADS = Counter(
+    "sws_downloads_total",
+    "Files downloaded, by file and content encoding",
+    ["file", "encoding"],
+)
+DOWNLOAD_BYTES = Counter(
+    "sws_download_bytes_total",
+    "Bytes of files downloaded, by file and content encoding",
+    ["file", "encoding"],
+)
+
+# durations (in seconds) of the phases of the current request, if timed
+_request_timings: ContextVar[Optional[dict[str, float]]] = ContextVar(
+    "request_timings", default=None
+)
+
+
+def start_request_timing() -> dict[str, float]:
+    timings: dict[str, float] = {}
+    _request_timings.set(timings)
+    return timings
+
+
+@contextmanager
+def timed(phase: str) -> Generator[None, None, None]:
+    """
+    Records the time spent in the block in the phase duration histogram,
+    and in the Server-Timing of the current request.
+    """
+    before = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - before
+        PHASE_DURATION.labels(phase).observe(elapsed)
+        timings = _request_timings.get()
+        if timings is not None:
+            timings[phase] = timings.get(phase, 0.0) + elapsed
+
+
+def format_server_timing(timings: dict[str, float]) -> str:
+    return ", ".join(
+        f"{phase};dur={seconds * 1000:.1f}" for phase, seconds in timings.items()
+    )
+
+
+def render_metrics() -> bytes:
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)  # type: ignore[no-untyped-call]
+        return generate_latest(registry)
+    return generate_latest(REGISTRY)
+
+
+def mark_worker_stopped() -> None:
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        multiprocess.mark_process_dead(os.getpid())  # type: ignore[no-untyped-call]
@@ -0,0 +1,272 @@
+import asyncio
+import fcntl
+import logging
+import mmap
+import os
+import sqlite3
+import struct
+import time
+from contextlib import closing, contextmanager
+from pathlib import Path
+from typing import Generator, Optional
+
+from .artifact_store import is_valid_model_id
+from .file_validation.compilation_files import compilation_files_exist
+from .locking import compilation_output_lock, remove_locked_directory
+
+logger = logging.getLogger(__name__)
+
+# How often accesses to models are written to the database
+_ACCESS_FLUSH_INTERVAL = 1.0
+
+# Model directories younger than this are never swept,
+# since a compilation may have just been requested for them
+_SWEEP_MIN_AGE = 600
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS models (
+    model_id TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    last_access REAL NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0
+)
+"""
+
+
+class ModelCache:
+    """
+    Keeps track of the compiled models in the cache and evicts the least
+    recently used ones when the cache grows beyond its budget.
+
+    The size, last access time, and hit count of each model are stored in an
+    SQLite database next to the models, which is shared by all workers.
+    Accesses are written to it in batches.
+
+    Each worker also remembers which models it has seen complete in the
+    cache, so it can answer cache hits without accessing the filesystem.
+    Every eviction increments a counter in a small file mapped into the
+    memory of all workers, which makes them forget these models.
+    """
+
+    def __init__(
+        self,
+        *,
+        built_model_dir: Path,
+        max_bytes: Optional[int],
+        max_models: Optional[int],
+    ) -> None:
+        self._built_model_dir = built_model_dir
+        self._db_file = built_model_dir / "cache.db"
+        self._max_bytes = max_bytes
+        self._max_models = max_models
+        built_model_dir.mkdir(parents=True, exist_ok=True)
+        with self._connect() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(_SCHEMA)
+
+        self._pending_accesses: dict[str, tuple[float, int]] = {}
+        self._last_flush = time.monotonic()
+
+        self._complete: set[str] = set()
+        self._evictions_fd, self._evictions = _map_counter(
+            built_model_dir / ".evictions"
+        )
+        self._evictions_seen = self._read_evictions()
+
+    @contextmanager
+    def _connect(self) -> Generator[sqlite3.Connection, None, None]:
+        with closing(sqlite3.connect(self._db_file, timeout=30)) as db:
+            with db:  # commits on success, rolls back on error
+                yield db
+
+    def _read_evictions(self) -> int:
+        count: int = struct.unpack_from("<Q", self._evictions)[0]
+        return count
+
+    def is_complete(self, model_id: str) -> bool:
+        """
+        Returns whether this worker has seen the model complete in the cache
+        since the last eviction. False does not mean the model is missing.
+        """
+        evictions = self._read_evictions()
+        if evictions != self._evictions_seen:
+            self._complete.clear()
+            self._evictions_seen = evictions
+        return model_id in self._complete
+
+    def mark_complete(self, model_id: str) -> None:
+        self._complete.add(model_id)
+
+    async def record_published(self, model_dir: Path) -> None:
+        await asyncio.to_thread(self._insert_model, model_dir)
+        self.mark_complete(model_dir.name)
+
+    def _insert_model(self, model_dir: Path) -> None:
+        with self._connect() as db:
+            db.execute(
+                "INSERT OR REPLACE INTO models VALUES (?, ?, ?, 0)",
+                (model_dir.name, _get_model_size(model_dir), time.time()),
+            )
+
+    async def record_access(self, model_id: str, hit: bool = False) -> None:
+        _, hits = self._pending_accesses.get(model_id, (0.0, 0))
+        self._pending_accesses[model_id] = (time.time(), hits + int(hit))
+        if time.monotonic() - self._last_flush >= _ACCESS_FLUSH_INTERVAL:
+            await asyncio.to_thread(self._write_accesses, self._take_accesses())
+
+    def flush_accesses(self) -> None:
+        self._write_accesses(self._take_accesses())
+
+    def _take_accesses(self) -> dict[str, tuple[float, int]]:
+        # only called on the event loop thread, like record_access,
+        # so that no access is recorded in a batch already taken
+        pending, self._pending_accesses = self._pending_accesses, {}
+        self._last_flush = time.monotonic()
+        return pending
+
+    def _write_accesses(self, pending: dict[str, tuple[float, int]]) -> None:
+        if not pending:
+            return
+        with self._connect() as db:
+            db.executemany(
+                "UPDATE models SET last_access = ?, hits = hits + ? WHERE model_id = ?",
+                [
+                    (last_access, hits, model_id)
+                    for model_id, (last_access, hits) in pending.items()
+                ],
+            )
+
+    def index_existing_models(self) -> None:
+        """
+        Adds models already on disk (e.g. from before the index existed)
+        to the index, using their modification time as the last access.
+        """
+        with self._connect() as db:
+            known = {row[0] for row in db.execute("SELECT model_id FROM models")}
+            for model_dir in self._built_model_dir.iterdir():
+                if model_dir.name in known or not model_dir.is_dir():
+                    continue
+                if not compilation_files_exist(model_dir):
+                    continue
+                db.execute(
+                    "INSERT OR IGNORE INTO models VALUES (?, ?, ?, 0)",
+                    (
+                        model_dir.name,
+                        _get_model_size(model_dir),
+                        model_dir.stat().st_mtime,
+                    ),
+                )
+
+    async def evict(self, keep: Optional[str] = None) -> None:
+        """
+        Removes least recently used models until the cache is within budget.
+
+        Models which are currently locked (for instance, being copied into the
+        cache) are skipped, as is the model named by ``keep``.
+        """
+        if self._max_bytes is None and self._max_models is None:
+            return
+        await asyncio.to_thread(self._evict, self._take_accesses(), keep)
+
+    def _evict(
+        self, pending: dict[str, tuple[float, int]], keep: Optional[str]
+    ) -> None:
+        self._write_accesses(pending)
+        with self._connect() as db:
+            rows = db.execute(
+                "SELECT model_id, size FROM models ORDER BY last_access"
+            ).fetchall()
+
+        total_bytes = sum(size for _, size in rows)
+        total_models = len(rows)
+        evicted = []
+        for model_id, size in rows:
+            if not self._over_budget(total_bytes, total_models):
+                break
+            if model_id == keep:
+                continue
+            model_dir = self._built_model_dir / model_id
+            with compilation_output_lock(model_dir) as exclusive:
+                if not exclusive:
+                    continue
+                remove_locked_directory(model_dir)
+            evicted.append(model_id)
+            total_bytes -= size
+            total_models -= 1
+
+        if evicted:
+            logger.info("Evicted %d models from the cache", len(evicted))
+            # only once the files are gone, so no worker can see them again
+            self._increment_evictions()
+            with self._connect() as db:
+                db.executemany(
+                    "DELETE FROM models WHERE model_id = ?",
+                    [(model_id,) for model_id in evicted],
+                )
+
+    def sweep_orphans(self, failure_ttl: int) -> int:
+        """
+        Removes the model directories which hold no model, such as those left
+        by compilations which failed or were turned away, once any failure
+        recorded in them has expired. Returns the number of directories removed.
+        """
+        # one sweep at a time, so that sweeps do not trip over each other
+        sweep_fd = os.open(
+            self._built_model_dir / ".sweep.lock", os.O_RDWR | os.O_CREAT, 0o644
+        )
+        try:
+            try:
+                fcntl.flock(sweep_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return 0
+            swept = 0
+            for model_dir in self._built_model_dir.iterdir():
+                if is_valid_model_id(model_dir.name) and self._sweep_orphan(
+                    model_dir, failure_ttl
+                ):
+                    swept += 1
+            return swept
+        finally:
+            os.close(sweep_fd)
+
+    def _sweep_orphan(self, model_dir: Path, failure_ttl: int) -> bool:
+        try:
+            age = time.time() - model_dir.stat().st_mtime
+        except FileNotFoundError:
+            return False
+        # the directory of a compilation is created when it is requested,
+        # and may soon be used
+        if age < max(_SWEEP_MIN_AGE, failure_ttl) or compilation_files_exist(model_dir):
+            return False
+        with compilation_output_lock(model_dir) as exclusive:
+            if not exclusive or compilation_files_exist(model_dir):
+                return False
+            logger.info("Sweeping model directory %s without a model", model_dir.name)
+            remove_locked_directory(model_dir)
+        return True
+
+    def _increment_evictions(self) -> None:
+        fcntl.flock(self._evictions_fd, fcntl.LOCK_EX)
+        try:
+            struct.pack_into("<Q", self._evictions, 0, self._read_evictions() + 1)
+        finally:
+            fcntl.flock(self._evictions_fd, fcntl.LOCK_UN)
+
+    def _over_budget(self, total_bytes: int, total_models: int) -> bool:
+        if self._max_bytes is not None and total_bytes > self._max_bytes:
+            return True
+        if self._max_models is not None and total_models > self._max_models:
+            return True
+        return False
+
+
+def _map_counter(path: Path) -> tuple[int, mmap.mmap]:
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    if os.fstat(fd).st_size < 8:
+        # extending a file fills it with zeros, so this is safe to race
+        os.ftruncate(fd, 8)
+    return fd, mmap.mmap(fd, 8)
+
+
+def _get_model_size(model_dir: Path) -> int:
+    return sum(f.stat().st_size for f in model_dir.iterdir() if f.is_file())
@@ -0,0 +1,15 @@
+from typing import Literal
+
+OptimizationProfile = Literal["default", "fast", "small"]
+
+# Arguments added to the make command for each profile. This list is fixed
+# here, rather than configurable, since make arguments can run commands.
+# Profiles which change the compiler flags cannot use the precompiled Stan
+# header, which is built with the flags from local.mk.
+OPTIMIZATION_PROFILES: dict[OptimizationProfile, list[str]] = {
+    "default": [],
+    # fastest sampling: SIMD instructions are supported by all current browsers
+    "fast": ["CXXFLAGS_OPTIM=-O3 -msimd128", "PRECOMPILED_HEADERS=false"],
+    # smallest download, for quick demos
+    "small": ["CXXFLAGS_OPTIM=-Oz", "PRECOMPILED_HEADERS=false"],
+}
@@ -0,0 +1,33 @@
+import fcntl
+import logging
+import os
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Generator
+
+logger = logging.getLogger(__name__)
+
+
+def find_stan_programs(directory: Path) -> list[Path]:
+    return sorted(path for path in directory.rglob("*.stan") if path.is_file())
+
+
+@contextmanager
+def startup_prewarm_lock(lock_dir: Path) -> Generator[bool, None, None]:
+    """
+    Context manager for the lock that lets only one of the workers sharing
+    ``lock_dir`` prewarm the cache at startup.
+    Yields True if the lock was acquired, False otherwise.
+    """
+    lock_dir.mkdir(parents=True, exist_ok=True)
+    fd = os.open(lock_dir / ".prewarm.lock", os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            logger.debug("Another worker is prewarming the cache")
+            yield False
+            return
+        yield True
+    finally:
+        os.close(fd)
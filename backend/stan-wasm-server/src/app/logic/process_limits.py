@@ -0,0 +1,65 @@
+import logging
+import shutil
+from dataclasses import dataclass
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class ProcessLimits:
+    """
+    Resource limits for the processes of a compilation.
+
+    The limits are applied by the shell running the build to itself, before
+    starting anything else, so every process of the build inherits them.
+    """
+
+    cpu_seconds: Optional[int] = None
+    memory_bytes: Optional[int] = None
+    nice: int = 0
+    low_io_priority: bool = False
+
+    def shell_prefix(self) -> str:
+        # the priorities are best-effort, since lowering them can be refused
+        # (for instance in sandboxed containers), which should not stop the
+        # build; the build is only run if the limits could be set, though
+        priorities = []
+        if self.nice:
+            priorities.append(f"renice -n {self.nice} -p $$")
+        if self.low_io_priority:
+            priorities.append("ionice -c 2 -n 7 -p $$")
+        limits = []
+        # note: these limits apply to each process of the build separately
+        if self.cpu_seconds is not None:
+            limits.append(f"ulimit -t {self.cpu_seconds}")
+        if self.memory_bytes is not None:
+            limits.append(f"ulimit -v {self.memory_bytes // 1024}")
+        return "".join(
+            f"{command} > /dev/null 2>&1 || true; " for command in priorities
+        ) + "".join(f"{command} && " for command in limits)
+
+
+def create_process_limits(
+    *,
+    cpu_seconds: Optional[int],
+    memory_bytes: Optional[int],
+    nice: int,
+    low_io_priority: bool,
+) -> ProcessLimits:
+    """
+    Returns the limits for compilations, leaving out the priorities
+    that cannot be set because renice or ionice is missing.
+    """
+    if nice and shutil.which("renice") is None:
+        logger.warning("renice not found, compilations will run at normal priority")
+        nice = 0
+    if low_io_priority and shutil.which("ionice") is None:
+        logger.warning("ionice not found, compilations will run at normal I/O priority")
+        low_io_priority = False
+    return ProcessLimits(
+        cpu_seconds=cpu_seconds,
+        memory_bytes=memory_bytes,
+        nice=nice,
+        low_io_priority=low_io_priority,
+    )
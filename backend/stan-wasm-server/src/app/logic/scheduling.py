@@ -0,0 +1,189 @@
+import asyncio
+import fcntl
+import logging
+import os
+from contextlib import asynccontextmanager, contextmanager
+from pathlib import Path
+from typing import AsyncIterator, Generator, Optional
+
+from .exceptions import StanPlaygroundServerBusyException
+from .metrics import QUEUE_DEPTH, timed
+
+logger = logging.getLogger(__name__)
+
+# How often the oldest waiter in a worker checks for a free slot
+_POLL_INTERVAL = 0.05
+# How often low priority compilations check whether they may run
+_LOW_PRIORITY_POLL_INTERVAL = 0.5
+
+
+class CompilationScheduler:
+    """
+    Limits how many compilations run at once on this host.
+
+    Running compilations and queued requests each hold a flock(2) lock on one
+    of a fixed number of files in ``state_dir``, which makes the limits hold
+    across all uvicorn workers sharing that directory. Locks are released by
+    the kernel if a worker dies, so a crash cannot leak a slot.
+
+    Within a worker, waiters are served in FIFO order. Across workers, new
+    requests do not take a free slot while others are already queued.
+    Low priority compilations (such as prewarming the cache) wait until
+    nothing else is queued, and always leave one slot free if there is
+    more than one.
+
+    Checks of programs with stanc alone are much shorter, and have limits of
+    their own: as many checks as ``max_concurrent_checks`` run at once, and as
+    many as ``max_queued`` wait in a queue separate from that of compilations.
+    """
+
+    def __init__(
+        self,
+        *,
+        state_dir: Path,
+        max_concurrent: int,
+        max_queued: int,
+        max_concurrent_checks: int,
+        retry_after: int,
+    ) -> None:
+        self._state_dir = state_dir
+        self._max_concurrent = max_concurrent
+        self._max_queued = max_queued
+        self._retry_after = retry_after
+        self._max_concurrent_checks = max_concurrent_checks
+        self._local_queue = asyncio.Lock()
+        self._local_check_queue = asyncio.Lock()
+        state_dir.mkdir(parents=True, exist_ok=True)
+
+    @asynccontextmanager
+    async def slot(
+        self,
+        low_priority: bool = False,
+        priority_raised: Optional[asyncio.Event] = None,
+    ) -> AsyncIterator[None]:
+        """
+        Waits for a compilation slot and holds it for the duration of the context.
+        Raises StanPlaygroundServerBusyException if the queue is full.
+        Low priority compilations are not counted in the queue, and never
+        raise StanPlaygroundServerBusyException, until ``priority_raised``
+        is set (for instance, because a user is waiting for them too), from
+        when they wait like any other compilation.
+        """
+        if low_priority:
+            fd = await self._wait_for_idle_slot(priority_raised)
+        else:
+            fd = await self._wait_for_slot()
+
+        try:
+            yield
+        finally:
+            os.close(fd)
+
+    @asynccontextmanager
+    async def check_slot(
+        self,
+        low_priority: bool = False,
+        priority_raised: Optional[asyncio.Event] = None,
+    ) -> AsyncIterator[None]:
+        """
+        Waits for a slot to check a program with stanc, and holds it for the
+        duration of the context. Raises StanPlaygroundServerBusyException if the
+        queue is full. Low priority checks are treated as in ``slot``.
+        """
+        fd = None
+        if not self._local_check_queue.locked():
+            fd = self._try_acquire_any("check", self._max_concurrent_checks)
+
+        while fd is None and low_priority and not _is_set(priority_raised):
+            await asyncio.sleep(_LOW_PRIORITY_POLL_INTERVAL)
+            fd = self._try_acquire_any("check", self._max_concurrent_checks)
+
+        if fd is None:
+            with self._queue_ticket("check-queued"), timed("check_queue"):
+                async with self._local_check_queue:
+                    while (
+                        fd := self._try_acquire_any(
+                            "check", self._max_concurrent_checks
+                        )
+                    ) is None:
+                        await asyncio.sleep(_POLL_INTERVAL)
+
+        try:
+            yield
+        finally:
+            os.close(fd)
+
+    async def _wait_for_slot(self) -> int:
+        fd = None
+        if not self._local_queue.locked() and not self._anyone_queued():
+            fd = self._try_acquire_any("slot", self._max_concurrent)
+
+        if fd is None:
+            with self._queue_ticket("queued"), timed("queue"):
+                async with self._local_queue:
+                    while (
+                        fd := self._try_acquire_any("slot", self._max_concurrent)
+                    ) is None:
+                        await asyncio.sleep(_POLL_INTERVAL)
+        return fd
+
+    async def _wait_for_idle_slot(
+        self, priority_raised: Optional[asyncio.Event]
+    ) -> int:
+        reserved = 1 if self._max_concurrent > 1 else 0
+        while not _is_set(priority_raised):
+            if not self._local_queue.locked() and not self._anyone_queued():
+                fd = self._try_acquire_any("slot", self._max_concurrent - reserved)
+                if fd is not None:
+                    return fd
+            await asyncio.sleep(_LOW_PRIORITY_POLL_INTERVAL)
+        return await self._wait_for_slot()
+
+    @contextmanager
+    def _queue_ticket(self, kind: str) -> Generator[None, None, None]:
+        ticket = self._try_acquire_any(kind, self._max_queued)
+        if ticket is None:
+            logger.warning("Queue %s is full (%d waiting)", kind, self._max_queued)
+            raise StanPlaygroundServerBusyException(self._retry_after)
+        QUEUE_DEPTH.inc()
+        try:
+            yield
+        finally:
+            QUEUE_DEPTH.dec()
+            os.close(ticket)
+
+    def _lockfile(self, kind: str, index: int) -> Path:
+        return self._state_dir / f"{kind}-{index}.lock"
+
+    def _try_acquire_any(self, kind: str, count: int) -> Optional[int]:
+        """
+        Takes an exclusive lock on the first free file of the given kind,
+        returning its descriptor (which must be closed to release the lock).
+        """
+        for i in range(count):
+            fd = os.open(self._lockfile(kind, i), os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                continue
+            return fd
+        return None
+
+    def _anyone_queued(self) -> bool:
+        for i in range(self._max_queued):
+            path = self._lockfile("queued", i)
+            if not path.exists():
+                continue
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return True
+            finally:
+                os.close(fd)
+        return False
+
+
+def _is_set(event: Optional[asyncio.Event]) -> bool:
+    return event is not None and event.is_set()
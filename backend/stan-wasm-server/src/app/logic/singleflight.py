@@ -0,0 +1,56 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, Generic, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class SingleFlight(Generic[T]):
+    """
+    Deduplicates concurrent calls for the same key within this process.
+
+    The first caller for a key starts the work; every caller that arrives
+    while it is still running awaits the same task and receives the same
+    result (or exception). The work is cancelled if every caller waiting
+    for it is cancelled.
+    """
+
+    def __init__(self) -> None:
+        self._in_flight: dict[str, asyncio.Task[T]] = {}
+        self._waiters: dict[str, int] = {}
+
+    def is_running(self, key: str) -> bool:
+        return key in self._in_flight
+
+    async def run(self, key: str, fn: Callable[[], Awaitable[T]]) -> T:
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda t: self._forget(key, t))
+        else:
+            logger.info("Joining in-flight work for %s", key)
+
+        self._waiters[key] = self._waiters.get(key, 0) + 1
+        try:
+            # shield so that one caller going away does not cancel the
+            # work that other callers are waiting on
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if self._waiters[key] == 1 and not task.done():
+                logger.info("Cancelling work for %s, nobody is waiting for it", key)
+                task.cancel()
+            raise
+        finally:
+            self._waiters[key] -= 1
+            if not self._waiters[key]:
+                del self._waiters[key]
+
+    def _forget(self, key: str, task: "asyncio.Task[T]") -> None:
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+        # mark the exception as retrieved, in case every waiter went away
+        if not task.cancelled():
+            task.exception()
@@ -1,32 +1,206 @@
-from contextlib import asynccontextmanager
-from typing import Annotated, Any, AsyncIterator, TypeVar
+import asyncio
+import json
+import logging
+import mimetypes
+import re
+from contextlib import asynccontextmanager, suppress
+from functools import lru_cache
+from pathlib import Path
+from typing import Annotated, Any, AsyncIterator, Coroutine, Optional, TypeVar
 
 from config import StanWasmServerSettings, get_settings
 from fastapi import BackgroundTasks, Body, Depends, FastAPI, Header, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
+from logic.artifact_store import ArtifactStore, create_artifact_store, is_valid_model_id
 from logic.authorization import check_authorization
-from logic.compilation import compile_and_cache, make_canonical_model_dir
+from logic.compilation import (
+    compile_and_cache,
+    compute_stan_program_hash,
+    fetch_from_artifact_store,
+    find_cached_model,
+    make_canonical_model_dir,
+)
 from logic.compilation_job_mgmt import (
+    compilation_job,
     create_compilation_job,
-    delete_compilation_job,
+    follow_job_output,
+    get_compilation_job_dir,
+    prune_compilation_job,
+    read_job_status,
+    release_compilation_job,
+    sweep_compilation_jobs,
     upload_stan_code_file,
+    write_job_status,
 )
+from logic.compiler_cache import get_compiler_cache_env
+from logic.compression import ENCODINGS, compressed_file_name, negotiate_encoding
 from logic.exceptions import (
     StanPlaygroundAuthenticationException,
     StanPlaygroundCompilationException,
     StanPlaygroundCompilationTimeoutException,
     StanPlaygroundInvalidFileException,
+    StanPlaygroundServerBusyException,
+)
+from logic.file_validation.compilation_files import (
+    COMPILATION_OUTPUTS,
+    validate_stan_code,
+)
+from logic.metrics import (
+    DOWNLOAD_BYTES,
+    DOWNLOADS,
+    format_server_timing,
+    mark_worker_stopped,
+    render_metrics,
+    start_request_timing,
+    timed,
 )
-from logic.file_validation.compilation_files import COMPILATION_OUTPUTS
+from logic.model_cache import ModelCache
+from logic.optimization_profiles import OptimizationProfile
+from logic.prewarm import find_stan_programs, startup_prewarm_lock
+from logic.process_limits import ProcessLimits, create_process_limits
+from logic.scheduling import CompilationScheduler
+from prometheus_client import CONTENT_TYPE_LATEST
+from starlette.requests import ClientDisconnect
+
+logger = logging.getLogger(__name__)
 
 DependsOnSettings = Annotated[StanWasmServerSettings, Depends(get_settings)]
 
 
+@lru_cache
+def get_scheduler() -> CompilationScheduler:
+    settings = get_settings()
+    return CompilationScheduler(
+        state_dir=settings.job_dir / ".scheduler",
+        max_concurrent=settings.max_concurrent_compilations,
+        max_queued=settings.max_queued_compilations,
+        retry_after=settings.busy_retry_after,
+        max_concurrent_checks=settings.max_concurrent_checks,
+    )
+
+
+DependsOnScheduler = Annotated[CompilationScheduler, Depends(get_scheduler)]
+
+
+@lru_cache
+def get_model_cache() -> ModelCache:
+    settings = get_settings()
+    return ModelCache(
+        built_model_dir=settings.built_model_dir,
+        max_bytes=settings.cache_max_bytes,
+        max_models=settings.cache_max_models,
+    )
+
+
+DependsOnModelCache = Annotated[ModelCache, Depends(get_model_cache)]
+
+
+@lru_cache
+def get_compiler_env() -> dict[str, str]:
+    settings = get_settings()
+    return get_compiler_cache_env(
+        settings.compiler_cache_dir,
+        settings.compiler_cache_max_size,
+        settings.job_dir,
+    )
+
+
+DependsOnCompilerEnv = Annotated[dict[str, str], Depends(get_compiler_env)]
+
+
+@lru_cache
+def get_process_limits() -> ProcessLimits:
+    settings = get_settings()
+    return create_process_limits(
+        cpu_seconds=settings.compilation_cpu_time_limit,
+        memory_bytes=settings.compilation_memory_limit,
+        nice=settings.compilation_nice,
+        low_io_priority=settings.compilation_low_io_priority,
+    )
+
+
+DependsOnProcessLimits = Annotated[ProcessLimits, Depends(get_process_limits)]
+
+
+@lru_cache
+def get_artifact_store() -> Optional[ArtifactStore]:
+    settings = get_settings()
+    return create_artifact_store(
+        settings.artifact_store_url, settings.artifact_store_endpoint_url
+    )
+
+
+DependsOnArtifactStore = Annotated[Optional[ArtifactStore], Depends(get_artifact_store)]
+
+
+# references to running asynchronous jobs, so they are not garbage collected
+_background_jobs: set[asyncio.Task[None]] = set()
+
+
+def start_background_job(coro: Coroutine[Any, Any, None]) -> "asyncio.Task[None]":
+    task = asyncio.create_task(coro)
+    _background_jobs.add(task)
+    task.add_done_callback(_background_jobs.discard)
+    return task
+
+
+# the prewarming running in this worker, only one of which runs at a time
+_prewarm_job: Optional["asyncio.Task[None]"] = None
+
+
+async def sweep_periodically(
+    settings: StanWasmServerSettings, cache: ModelCache
+) -> None:
+    """
+    Removes the job directories abandoned by stopped workers, and the model
+    directories left without a model, once at startup and then every
+    ``job_sweep_interval`` seconds.
+    """
+    while True:
+        try:
+            swept = await asyncio.to_thread(sweep_compilation_jobs, settings.job_dir)
+        except Exception:
+            logger.exception("Failed to sweep %s", settings.job_dir)
+        else:
+            if swept:
+                logger.info("Swept %d abandoned job directories", swept)
+        try:
+            swept = await asyncio.to_thread(
+                cache.sweep_orphans, settings.failure_cache_ttl
+            )
+        except Exception:
+            logger.exception("Failed to sweep %s", settings.built_model_dir)
+        else:
+            if swept:
+                logger.info("Swept %d model directories without a model", swept)
+        await asyncio.sleep(settings.job_sweep_interval)
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    global _prewarm_job
     setup_logger()
+    settings = get_settings()
+    cache = get_model_cache()
+    await asyncio.to_thread(cache.index_existing_models)
+    await cache.evict()
+    start_background_job(sweep_periodically(settings, cache))
+    if settings.prewarm_dir is not None:
+        _prewarm_job = start_background_job(
+            prewarm_from_directory(
+                settings.prewarm_dir,
+                settings,
+                get_scheduler(),
+                cache,
+                get_compiler_env(),
+                get_artifact_store(),
+                get_process_limits(),
+            )
+        )
     yield
+    cache.flush_accesses()
+    mark_worker_stopped()
 
 
 def setup_logger() -> None:
@@ -82,6 +256,51 @@ exceptions_codes = [
 for e in exceptions_codes:
     register_exn_handler(*e)
 
+handled_exceptions = tuple(cls for cls, _ in exceptions_codes)
+
+
+@app.exception_handler(ClientDisconnect)
+async def client_disconnect_handler(
+    _request: Request, _exc: ClientDisconnect
+) -> Response:
+    # nobody receives this, but it keeps the disconnect out of the error logs
+    return Response(status_code=499)
+
+
+@app.exception_handler(StanPlaygroundServerBusyException)
+async def server_busy_handler(
+    _request: Request, exc: StanPlaygroundServerBusyException
+) -> JSONResponse:
+    return JSONResponse(
+        status_code=503,
+        content={"message": str(exc)},
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
+
+# How often a request waiting for a compilation checks if the client is gone
+_DISCONNECT_POLL_INTERVAL = 1.0
+
+
+async def cancel_on_disconnect(
+    request: Request, work: Coroutine[Any, Any, None]
+) -> None:
+    """
+    Runs the work, cancelling it if the client disconnects first,
+    so that compilations nobody is waiting for are stopped.
+    """
+    task = asyncio.ensure_future(work)
+    while True:
+        done, _ = await asyncio.wait({task}, timeout=_DISCONNECT_POLL_INTERVAL)
+        if done:
+            return task.result()
+        if await request.is_disconnected():
+            logger.info("Client disconnected, cancelling %s", request.url.path)
+            task.cancel()
+            with suppress(asyncio.CancelledError):
+                await task
+            raise ClientDisconnect()
+
 
 # Routing
 
@@ -97,52 +316,364 @@ async def probe() -> DictResponse:
 @app.head("/download/{model_id}/{filename}")
 @app.get("/download/{model_id}/{filename}")
 async def download_file(
-    model_id: str, filename: str, settings: DependsOnSettings
+    model_id: str,
+    filename: str,
+    settings: DependsOnSettings,
+    cache: DependsOnModelCache,
+    store: DependsOnArtifactStore,
+    request: Request,
+    accept_encoding: Optional[str] = Header(None),
 ) -> FileResponse:
     if filename not in COMPILATION_OUTPUTS:
         raise StanPlaygroundInvalidFileException(f"Invalid file name {filename}")
+    # checked before the id is used in any path, or passed to the store
+    if not is_valid_model_id(model_id):
+        raise FileNotFoundError(f"Model not found: {model_id}")
 
-    model_dir = settings.built_model_dir / model_id
+    timings = start_request_timing()
 
-    file_path = model_dir / filename
-    if not file_path.is_file():
-        raise FileNotFoundError(f"File not found: {file_path}")
-    return FileResponse(
-        file_path,
-        headers={
+    with timed("lookup"):
+        model_dir = settings.built_model_dir / model_id
+
+        file_path = model_dir / filename
+        if not file_path.is_file() and store is not None:
+            await fetch_from_artifact_store(
+                model_dir=model_dir, store=store, cache=cache
+            )
+        if not file_path.is_file():
+            raise FileNotFoundError(f"File not found: {file_path}")
+        await cache.record_access(model_id)
+
+        headers = {
             "Cross-Origin-Embedder-Policy": "require-corp",
             "Cross-Origin-Opener-Policy": "same-origin",
-        },
+            "Vary": "Accept-Encoding",
+        }
+        available = [
+            encoding
+            for encoding in ENCODINGS
+            if (model_dir / compressed_file_name(filename, encoding)).is_file()
+        ]
+        encoding = negotiate_encoding(accept_encoding, available)
+        if encoding is not None:
+            file_path = model_dir / compressed_file_name(filename, encoding)
+            headers["Content-Encoding"] = encoding
+
+    if request.method == "GET":
+        DOWNLOADS.labels(filename, encoding or "identity").inc()
+        DOWNLOAD_BYTES.labels(filename, encoding or "identity").inc(
+            file_path.stat().st_size
+        )
+    headers["Server-Timing"] = format_server_timing(timings)
+
+    return FileResponse(
+        file_path,
+        media_type=mimetypes.guess_type(filename)[0],
+        headers=headers,
     )
 
 
 @app.post("/compile")
 async def compile_stan(
     settings: DependsOnSettings,
-    background_tasks: BackgroundTasks,
+    scheduler: DependsOnScheduler,
+    cache: DependsOnModelCache,
+    compiler_env: DependsOnCompilerEnv,
+    store: DependsOnArtifactStore,
+    limits: DependsOnProcessLimits,
+    request: Request,
+    response: Response,
     authorization: str = Header(None),
     code: bytes = Body(...),
+    profile: OptimizationProfile = "default",
+) -> DictResponse:
+    check_authorization(authorization, settings.passcode)
+
+    timings = start_request_timing()
+
+    # cache hits are answered before anything is written to disk
+    with timed("hash"):
+        validate_stan_code(code)
+        model_id = compute_stan_program_hash(
+            code, normalize=settings.normalize_program_hash, profile=profile
+        )
+    model_dir = (settings.built_model_dir / model_id).absolute()
+
+    if not await find_cached_model(model_dir, cache):
+        # the job directory is removed however the compilation ends
+        with compilation_job(base_dir=settings.job_dir) as job_dir:
+            with timed("upload"):
+                src_file = upload_stan_code_file(job_dir, code)
+            model_dir.mkdir(parents=True, exist_ok=True)
+
+            await cancel_on_disconnect(
+                request,
+                compile_and_cache(
+                    src_file=src_file,
+                    model_dir=model_dir,
+                    tinystan_dir=settings.tinystan,
+                    timeout=settings.compilation_timeout,
+                    scheduler=scheduler,
+                    cache=cache,
+                    failure_ttl=settings.failure_cache_ttl,
+                    stanc_timeout=settings.stanc_timeout,
+                    compiler_env=compiler_env,
+                    store=store,
+                    limits=limits,
+                    profile=profile,
+                ),
+            )
+
+    response.headers["Server-Timing"] = format_server_timing(timings)
+    return {"model_id": model_dir.name}
+
+
+async def run_compilation_job(
+    job_dir: Path,
+    src_file: Path,
+    settings: StanWasmServerSettings,
+    scheduler: CompilationScheduler,
+    cache: ModelCache,
+    compiler_env: dict[str, str],
+    store: Optional[ArtifactStore],
+    limits: ProcessLimits,
+    profile: OptimizationProfile,
+) -> None:
+    try:
+        model_dir = make_canonical_model_dir(
+            src_file=src_file,
+            built_model_dir=settings.built_model_dir,
+            normalize=settings.normalize_program_hash,
+            profile=profile,
+        )
+        await compile_and_cache(
+            src_file=src_file,
+            model_dir=model_dir,
+            tinystan_dir=settings.tinystan,
+            timeout=settings.compilation_timeout,
+            scheduler=scheduler,
+            cache=cache,
+            failure_ttl=settings.failure_cache_ttl,
+            stanc_timeout=settings.stanc_timeout,
+            compiler_env=compiler_env,
+            store=store,
+            limits=limits,
+            profile=profile,
+        )
+    except StanPlaygroundServerBusyException as exc:
+        # not a failure of the program, so the client may submit it again later
+        write_job_status(job_dir, "busy", message=str(exc), retry_after=exc.retry_after)
+    except Exception as exc:
+        if not isinstance(exc, handled_exceptions):
+            logger.exception("Unexpected error in compilation job %s", job_dir.name)
+        write_job_status(job_dir, "failed", message=str(exc))
+    else:
+        write_job_status(job_dir, "completed", model_id=model_dir.name)
+
+    # keep only the records of the job for clients that are still polling
+    try:
+        prune_compilation_job(job_dir)
+        await asyncio.sleep(settings.job_record_retention)
+    finally:
+        release_compilation_job(job_dir)
+
+
+@app.post("/compile/jobs", status_code=202)
+async def submit_compilation_job(
+    settings: DependsOnSettings,
+    scheduler: DependsOnScheduler,
+    cache: DependsOnModelCache,
+    compiler_env: DependsOnCompilerEnv,
+    store: DependsOnArtifactStore,
+    limits: DependsOnProcessLimits,
+    authorization: str = Header(None),
+    code: bytes = Body(...),
+    profile: OptimizationProfile = "default",
 ) -> DictResponse:
     check_authorization(authorization, settings.passcode)
 
     job_dir = create_compilation_job(base_dir=settings.job_dir)
 
-    src_file = upload_stan_code_file(job_dir, code)
+    try:
+        src_file = upload_stan_code_file(job_dir, code)
+        write_job_status(job_dir, "pending")
+    except BaseException:
+        release_compilation_job(job_dir)
+        raise
+
+    start_background_job(
+        run_compilation_job(
+            job_dir,
+            src_file,
+            settings,
+            scheduler,
+            cache,
+            compiler_env,
+            store,
+            limits,
+            profile,
+        )
+    )
+
+    return {"job_id": job_dir.name}
+
 
-    model_dir = make_canonical_model_dir(
-        src_file=src_file, built_model_dir=settings.built_model_dir
+# Job ids are unguessable, so (like downloads) the status and output
+# endpoints do not require authorization. This lets browsers follow
+# the output with an EventSource, which cannot send headers.
+@app.get("/compile/jobs/{job_id}")
+async def get_compilation_job_status(
+    job_id: str, settings: DependsOnSettings
+) -> DictResponse:
+    job_dir = get_compilation_job_dir(settings.job_dir, job_id)
+    return read_job_status(job_dir)
+
+
+@app.get("/compile/jobs/{job_id}/output")
+async def stream_compilation_job_output(
+    job_id: str, settings: DependsOnSettings
+) -> StreamingResponse:
+    job_dir = get_compilation_job_dir(settings.job_dir, job_id)
+
+    async def events() -> AsyncIterator[str]:
+        async for record in follow_job_output(job_dir):
+            if "stream" in record:
+                yield _server_sent_event(record["stream"], record["line"])
+            else:
+                yield _server_sent_event("status", json.dumps(record))
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"},
     )
 
-    await compile_and_cache(
-        src_file=src_file,
-        model_dir=model_dir,
-        tinystan_dir=settings.tinystan,
-        timeout=settings.compilation_timeout,
+
+def _server_sent_event(event: str, data: str) -> str:
+    # any line break ends a data field, so each line of the data
+    # is sent as a field of its own, which clients join back together
+    lines = re.split(r"\r\n|\r|\n", data)
+    return f"event: {event}\n" + "".join(f"data: {line}\n" for line in lines) + "\n"
+
+
+async def prewarm_models(
+    programs: list[tuple[str, bytes]],
+    settings: StanWasmServerSettings,
+    scheduler: CompilationScheduler,
+    cache: ModelCache,
+    compiler_env: dict[str, str],
+    store: Optional[ArtifactStore],
+    limits: ProcessLimits,
+) -> None:
+    """
+    Compiles the programs one at a time at low priority, so that they are
+    already cached when users first request them.
+    """
+    compiled = 0
+    for name, code in programs:
+        job_dir = create_compilation_job(base_dir=settings.job_dir)
+        try:
+            src_file = upload_stan_code_file(job_dir, code)
+            model_dir = make_canonical_model_dir(
+                src_file=src_file,
+                built_model_dir=settings.built_model_dir,
+                normalize=settings.normalize_program_hash,
+            )
+            await compile_and_cache(
+                src_file=src_file,
+                model_dir=model_dir,
+                tinystan_dir=settings.tinystan,
+                timeout=settings.compilation_timeout,
+                scheduler=scheduler,
+                cache=cache,
+                failure_ttl=settings.failure_cache_ttl,
+                stanc_timeout=settings.stanc_timeout,
+                compiler_env=compiler_env,
+                store=store,
+                limits=limits,
+                low_priority=True,
+            )
+        except Exception as exc:
+            # including being turned away, once a user asked for the same
+            # program and the compilation stopped giving way to others
+            if isinstance(
+                exc, (*handled_exceptions, StanPlaygroundServerBusyException)
+            ):
+                logger.warning("Failed to prewarm %s: %s", name, exc)
+            else:
+                logger.exception("Unexpected error prewarming %s", name)
+        else:
+            compiled += 1
+        finally:
+            release_compilation_job(job_dir)
+
+    logger.info("Prewarmed %d of %d models", compiled, len(programs))
+
+
+async def prewarm_from_directory(
+    directory: Path,
+    settings: StanWasmServerSettings,
+    scheduler: CompilationScheduler,
+    cache: ModelCache,
+    compiler_env: dict[str, str],
+    store: Optional[ArtifactStore],
+    limits: ProcessLimits,
+) -> None:
+    with startup_prewarm_lock(settings.job_dir) as acquired:
+        if not acquired:
+            return
+        programs = [
+            (str(path), path.read_bytes()) for path in find_stan_programs(directory)
+        ]
+        logger.info("Prewarming %d models from %s", len(programs), directory)
+        await prewarm_models(
+            programs, settings, scheduler, cache, compiler_env, store, limits
+        )
+
+
+@app.post("/prewarm", status_code=202)
+async def prewarm(
+    settings: DependsOnSettings,
+    scheduler: DependsOnScheduler,
+    cache: DependsOnModelCache,
+    compiler_env: DependsOnCompilerEnv,
+    store: DependsOnArtifactStore,
+    limits: DependsOnProcessLimits,
+    authorization: str = Header(None),
+    programs: list[str] = Body(...),
+) -> DictResponse:
+    global _prewarm_job
+    if settings.restart_token is None:
+        raise StanPlaygroundAuthenticationException("Restart token not set at startup")
+    check_authorization(authorization, settings.restart_token)
+
+    if len(programs) > settings.prewarm_max_programs:
+        raise StanPlaygroundInvalidFileException(
+            f"Too many programs, at most {settings.prewarm_max_programs} are allowed."
+        )
+    for code in programs:
+        validate_stan_code(code.encode())
+
+    if _prewarm_job is not None and not _prewarm_job.done():
+        raise StanPlaygroundServerBusyException(settings.busy_retry_after)
+    _prewarm_job = start_background_job(
+        prewarm_models(
+            [(f"program {i}", code.encode()) for i, code in enumerate(programs)],
+            settings,
+            scheduler,
+            cache,
+            compiler_env,
+            store,
+            limits,
+        )
     )
 
-    background_tasks.add_task(delete_compilation_job, job_dir)
+    return {"queued": len(programs)}
 
-    return {"model_id": model_dir.name}
+
+@app.get("/metrics")
+async def metrics() -> Response:
+    return Response(render_metrics(), media_type=CONTENT_TYPE_LATEST)
 
 
 def send_interrupt() -> None:
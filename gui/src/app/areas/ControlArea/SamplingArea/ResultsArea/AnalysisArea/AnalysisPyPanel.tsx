@@ -1,7 +1,14 @@
-import { FunctionComponent, RefObject, useCallback, useMemo } from "react";
+import {
+  FunctionComponent,
+  RefObject,
+  use,
+  useCallback,
+  useMemo,
+} from "react";
 import { NeedsSamplerState } from "@SpCore/StanSampler/SamplerTypes";
 import { FileNames } from "@SpCore/Project/FileMapping";
 import { ProjectKnownFiles } from "@SpCore/Project/ProjectDataModel";
+import { UserSettingsContext } from "@SpCore/Settings/UserSettings";
 import useTemplatedFillerText from "@SpComponents/FileEditor/useTemplatedFillerText";
 import {
   clearOutputDivs,
@@ -10,6 +17,8 @@ import {
 import PlottingScriptEditor from "@SpComponents/FileEditor/PlottingScriptEditor";
 
 import usePyodideWorker from "@SpCore/Scripting/pyodide/usePyodideWorker";
+import { PlotImage } from "@SpCore/Scripting/pyodide/pyodideWorkerTypes";
+import packDraws from "@SpCore/Scripting/pyodide/packDraws";
 
 import useAnalysisState from "./useAnalysisState";
 import analysisPyTemplate from "./code_templates/analysis.py?raw";
@@ -32,7 +41,7 @@ const AnalysisPyPanel: FunctionComponent<NeedsSamplerState> = ({
     () => ({
       onStdout: (x: string) => writeConsoleOutToDiv(consoleRef, x, "stdout"),
       onStderr: (x: string) => writeConsoleOutToDiv(consoleRef, x, "stderr"),
-      onImage: (b64: string) => addImageToDiv(imagesRef, b64),
+      onImage: (image: PlotImage) => addImageToDiv(imagesRef, image),
       onStatus,
     }),
     [consoleRef, imagesRef, onStatus],
@@ -40,12 +49,23 @@ const AnalysisPyPanel: FunctionComponent<NeedsSamplerState> = ({
 
   const { run, cancel } = usePyodideWorker(callbacks);
 
+  const { compactDraws } = use(UserSettingsContext);
+
+  // packed once per sampling run, rather than converted value by value in
+  // Python. With the compact draws setting they are packed as float32, so
+  // that they are never held in double precision
+  const packedData = useMemo(
+    () =>
+      spData ? packDraws(spData, { compact: compactDraws }) : undefined,
+    [spData, compactDraws],
+  );
+
   const handleRun = useCallback(
     (code: string) => {
       clearOutputDivs(consoleRef, imagesRef);
       run({
         code,
-        spData,
+        spData: packedData,
         spRunSettings: {
           loadsDraws: true,
           showsPlots: true,
@@ -55,7 +75,7 @@ const AnalysisPyPanel: FunctionComponent<NeedsSamplerState> = ({
         files,
       });
     },
-    [consoleRef, imagesRef, run, spData, files],
+    [consoleRef, imagesRef, run, packedData, files],
   );
 
   const contentOnEmpty = useTemplatedFillerText(
@@ -81,14 +101,22 @@ const AnalysisPyPanel: FunctionComponent<NeedsSamplerState> = ({
   );
 };
 
+const imageMimeTypes = {
+  png: "image/png",
+  svg: "image/svg+xml",
+} as const;
+
 const addImageToDiv = (
   imagesRef: RefObject<HTMLDivElement | null>,
-  b64: string,
+  image: PlotImage,
 ) => {
-  const imageUrl = `data:image/png;base64,${b64}`;
+  const blob = new Blob([image.data], { type: imageMimeTypes[image.format] });
+  const imageUrl = URL.createObjectURL(blob);
 
   const img = document.createElement("img");
   img.style.width = "100%";
+  // the image is kept by the element once loaded
+  img.onload = () => URL.revokeObjectURL(imageUrl);
   img.src = imageUrl;
 
   const divElement = document.createElement("div");
@@ -0,0 +1,50 @@
+type Draws = {
+  draws: number[][];
+  paramNames: string[];
+  numChains: number;
+};
+
+// Draws laid out for sp_load_draws.py to use without any conversion:
+// one buffer indexed by (chain, draw, parameter), which pyodide passes
+// to Python as a memoryview for numpy to wrap. The buffer holds doubles,
+// or single precision floats for draws which are packed compact (see
+// DrawsObject.compact), which takes half the memory in both languages.
+export type PackedDraws = {
+  draws: Float64Array | Float32Array;
+  drawsShape: [number, number, number];
+  drawsDtype: "float64" | "float32";
+  paramNames: string[];
+  numChains: number;
+};
+
+type PackOptions = {
+  compact?: boolean;
+};
+
+const packDraws = (
+  { draws, paramNames, numChains }: Draws,
+  { compact = false }: PackOptions = {},
+): PackedDraws => {
+  const numParams = draws.length;
+  const numDraws = numParams > 0 ? draws[0].length / numChains : 0;
+
+  // draws come in as num_params by (num_chains * num_draws)
+  const size = numChains * numDraws * numParams;
+  const packed = compact ? new Float32Array(size) : new Float64Array(size);
+  for (let p = 0; p < numParams; p++) {
+    const column = draws[p];
+    for (let i = 0; i < column.length; i++) {
+      packed[i * numParams + p] = column[i];
+    }
+  }
+
+  return {
+    draws: packed,
+    drawsShape: [numChains, numDraws, numParams],
+    drawsDtype: compact ? "float32" : "float64",
+    paramNames,
+    numChains,
+  };
+};
+
+export default packDraws;
@@ -4,6 +4,7 @@ import { InterpreterStatus } from "@SpCore/Scripting/InterpreterTypes";
 import {
   MessageFromPyodideWorker,
   MessageToPyodideWorker,
+  PlotImage,
   PyodideRunSettings,
 } from "./pyodideWorkerTypes";
 import spDrawsScript from "./sp_load_draws.py?raw";
@@ -29,8 +30,11 @@ const loadPyodideInstance = async () => {
   return pyodide;
 };
 
-const sendMessageToMain = (message: MessageFromPyodideWorker) => {
-  self.postMessage(message);
+const sendMessageToMain = (
+  message: MessageFromPyodideWorker,
+  transfer: Transferable[] = [],
+) => {
+  self.postMessage(message, { transfer });
 };
 
 const sendStdout = (data: string) => {
@@ -49,8 +53,50 @@ const setData = (data: any) => {
   sendMessageToMain({ type: "setData", data });
 };
 
-const addImage = (image: any) => {
-  sendMessageToMain({ type: "addImage", image });
+// Images are sent as soon as they are made, unless others were sent very
+// recently: then they are held back for the rest of the interval, to be sent
+// together with any made in the meantime. The timer fires once the worker's
+// event loop runs again, and any images still held are sent when the script
+// ends. Their buffers are transferred to the main thread rather than copied.
+const MAX_IMAGES_PER_MESSAGE = 16;
+const IMAGE_BATCH_INTERVAL_MS = 250;
+
+let pendingImages: PlotImage[] = [];
+let lastImagesSentMs = 0;
+let sendImagesTimer: ReturnType<typeof setTimeout> | undefined = undefined;
+
+const addImage = (
+  format: PlotImage["format"],
+  data: Uint8Array<ArrayBuffer>,
+) => {
+  pendingImages.push({ format, data });
+  const sinceLastSentMs = performance.now() - lastImagesSentMs;
+  if (
+    pendingImages.length >= MAX_IMAGES_PER_MESSAGE ||
+    sinceLastSentMs >= IMAGE_BATCH_INTERVAL_MS
+  ) {
+    sendImages();
+  } else if (sendImagesTimer === undefined) {
+    sendImagesTimer = setTimeout(
+      sendImages,
+      IMAGE_BATCH_INTERVAL_MS - sinceLastSentMs,
+    );
+  }
+};
+
+const sendImages = () => {
+  clearTimeout(sendImagesTimer);
+  sendImagesTimer = undefined;
+  if (pendingImages.length === 0) {
+    return;
+  }
+  const images = pendingImages;
+  pendingImages = [];
+  lastImagesSentMs = performance.now();
+  sendMessageToMain(
+    { type: "addImages", images },
+    images.map((image) => image.data.buffer),
+  );
 };
 
 self.onmessage = async (e: MessageEvent<MessageToPyodideWorker>) => {
@@ -68,6 +114,26 @@ self.onmessage = async (e: MessageEvent<MessageToPyodideWorker>) => {
 };
 console.log("pyodide worker initialized");
 
+// The data of the latest sampling run. Its draws are only sent the first time
+// it is analyzed (see usePyodideWorker), and kept here for the later runs.
+let latestSpData: Record<string, any> | undefined = undefined;
+
+const withLatestDraws = (
+  spData: Record<string, any> | undefined,
+): Record<string, any> | undefined => {
+  if (spData?.runId === undefined) {
+    return spData;
+  }
+  if (spData.draws !== undefined) {
+    latestSpData = spData;
+    return spData;
+  }
+  if (latestSpData?.runId !== spData.runId) {
+    throw new Error(`Draws of sampling run ${spData.runId} are missing`);
+  }
+  return latestSpData;
+};
+
 console.log("opportunistically loading pyodide");
 const pyodidePromise: Promise<PyodideInterface> = loadPyodideInstance();
 
@@ -80,6 +146,7 @@ const run = async (
 ) => {
   setStatus("loading");
   try {
+    spData = withLatestDraws(spData);
     const pyodide = await pyodidePromise;
     if (interruptBuffer) {
       pyodide.setInterruptBuffer(interruptBuffer);
@@ -91,14 +158,26 @@ const run = async (
     const globalsJS: { [key: string]: any } = {
       _stan_playground: true,
     };
+    // a buffer of draws is left in JavaScript, to only be copied to Python
+    // by sp_load_draws if it does not already have the draws of the run
+    const drawsBuffer = ArrayBuffer.isView(spData?.draws)
+      ? spData?.draws
+      : undefined;
     if (spData) {
-      globalsJS._SP_DATA_IN = spData;
+      globalsJS._SP_DATA_IN = drawsBuffer
+        ? { ...spData, draws: undefined }
+        : spData;
     }
     if (spPySettings.showsPlots) {
       globalsJS._SP_ADD_IMAGE = addImage;
     }
 
     const globals = pyodide.toPy(globalsJS);
+    if (drawsBuffer) {
+      const spDataPy = globals.get("_SP_DATA_IN");
+      spDataPy.set("draws", drawsBuffer);
+      spDataPy.destroy();
+    }
 
     const script = scriptPreamble + "\n" + code + "\n" + scriptPostamble;
 
@@ -146,6 +225,7 @@ const run = async (
       console.error(e);
       sendStderr(e.toString());
     } finally {
+      sendImages();
       if (files) {
         const promises = [];
         for (const { name } of files) {
@@ -12,6 +12,12 @@ export type PyodideRunSettings = Partial<{
   filenameForErrors: string;
 }>;
 
+// A figure made by the script, as the bytes of the file of the given format
+export type PlotImage = {
+  format: "png" | "svg";
+  data: Uint8Array<ArrayBuffer>;
+};
+
 export type MessageToPyodideWorker = {
   type: "run";
   code: string;
@@ -46,8 +52,8 @@ export type MessageFromPyodideWorker =
       data: any;
     }
   | {
-      type: "addImage";
-      image: any;
+      type: "addImages";
+      images: PlotImage[];
     };
 
 export const isMessageFromPyodideWorker = (
@@ -58,6 +64,6 @@ export const isMessageFromPyodideWorker = (
   if (x.type === "stderr") return x.data !== undefined;
   if (x.type === "setStatus") return isInterpreterStatus(x.status);
   if (x.type === "setData") return x.data !== undefined;
-  if (x.type === "addImage") return x.image !== undefined;
+  if (x.type === "addImages") return Array.isArray(x.images);
   return false;
 };
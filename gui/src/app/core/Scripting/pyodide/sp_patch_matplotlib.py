@@ -1,30 +1,38 @@
 # see https://github.com/pyodide/matplotlib-pyodide/issues/6#issuecomment-1242747625
-# replace show() with a function that base64 encodes the image and then stashes it for us
+# replace show() with a function that saves the image and then stashes it for us
 
 
-from typing import Callable
+from typing import Any, Callable
 
+# formats which can be shown in the browser; the format, resolution, and size
+# of the images are matplotlib's savefig.format, savefig.dpi, and
+# figure.figsize settings, e.g. plt.rcParams["savefig.format"] = "svg"
+_IMAGE_FORMATS = ("png", "svg")
 
-def patch_matplotlib(post_image: Callable[[str], None]) -> None:
+
+def patch_matplotlib(post_image: Callable[[str, Any], None]) -> None:
     import os
 
     os.environ["MPLBACKEND"] = "AGG"
-    import base64
     from io import BytesIO
 
     import matplotlib.pyplot
+    from pyodide.ffi import to_js
 
     matplotlib.pyplot.clf()
 
     _old_show = matplotlib.pyplot.show
 
     def show() -> None:
+        image_format = matplotlib.rcParams["savefig.format"]
+        if image_format not in _IMAGE_FORMATS:
+            image_format = "png"
         buf = BytesIO()
-        matplotlib.pyplot.savefig(buf, format="png")
-        buf.seek(0)
-        # encode to a base64 str
-        str_image = base64.b64encode(buf.read()).decode("utf-8")
-        post_image(str_image)
+        matplotlib.pyplot.savefig(buf, format=image_format)
+        # the bytes are copied once, into a JavaScript buffer
+        # which is then transferred to the main thread
+        with buf.getbuffer() as image:
+            post_image(image_format, to_js(image))
         matplotlib.pyplot.clf()
 
     matplotlib.pyplot.show = show
@@ -7,6 +7,7 @@ import pyodideWorkerURL from "./pyodideWorker?worker&url";
 import {
   MessageToPyodideWorker,
   isMessageFromPyodideWorker,
+  PlotImage,
   PyodideRunSettings,
 } from "./pyodideWorkerTypes";
 import { File } from "@SpUtil/files";
@@ -16,7 +17,7 @@ type PyodideWorkerCallbacks = {
   onStderr: (data: string) => void;
   onStatus: (status: InterpreterStatus) => void;
   onData?: (data: any) => void;
-  onImage?: (image: string) => void;
+  onImage?: (image: PlotImage) => void;
 };
 
 type RunPyProps = {
@@ -26,9 +27,14 @@ type RunPyProps = {
   files?: File[];
 };
 
+// identifies the sampling runs whose data is sent to the workers
+let nextRunId = 0;
+
 class PyodideWorkerInterface {
   #worker: Worker | undefined;
   #interruptBuffer: Uint8Array | undefined;
+  // the data last sent to the worker, which keeps its draws
+  #sentSpData: { spData: Record<string, any>; runId: number } | undefined;
 
   private constructor(private callbacks: PyodideWorkerCallbacks) {
     // do not call this directly, use create() instead
@@ -49,6 +55,7 @@ class PyodideWorkerInterface {
       );
       this.#interruptBuffer = undefined;
     }
+    this.#sentSpData = undefined;
 
     this.#worker.onmessage = (e: MessageEvent) => {
       const msg = e.data;
@@ -67,12 +74,14 @@ class PyodideWorkerInterface {
           return;
         }
         this.callbacks.onData(msg.data);
-      } else if (msg.type === "addImage") {
+      } else if (msg.type === "addImages") {
         if (!this.callbacks.onImage) {
           console.error("onImage callback is required for plotting");
           return;
         }
-        this.callbacks.onImage(msg.image);
+        for (const image of msg.images) {
+          this.callbacks.onImage(image);
+        }
       }
     };
   }
@@ -90,15 +99,15 @@ class PyodideWorkerInterface {
   }
 
   run({ code, spData, spRunSettings, files }: RunPyProps) {
-    const msg: MessageToPyodideWorker = {
-      type: "run",
-      code,
-      spData,
-      spRunSettings,
-      files,
-      interruptBuffer: this.#interruptBuffer,
-    };
     if (this.#worker) {
+      const msg: MessageToPyodideWorker = {
+        type: "run",
+        code,
+        spData: this.#spDataToSend(spData),
+        spRunSettings,
+        files,
+        interruptBuffer: this.#interruptBuffer,
+      };
       if (this.#interruptBuffer) {
         // clear in case previous run was interrupted
         this.#interruptBuffer[0] = 0;
@@ -109,6 +118,20 @@ class PyodideWorkerInterface {
     }
   }
 
+  #spDataToSend(spData: Record<string, any> | undefined) {
+    if (spData === undefined) {
+      return undefined;
+    }
+    if (this.#sentSpData?.spData === spData) {
+      // the same data (and so the same sampling run) as the previous run:
+      // the worker still has the draws, loaded into Python
+      return { ...spData, draws: undefined, runId: this.#sentSpData.runId };
+    }
+    const runId = nextRunId++;
+    this.#sentSpData = { spData, runId };
+    return { ...spData, runId };
+  }
+
   cancel() {
     if (this.#interruptBuffer && this.#interruptBuffer[0] === 0) {
       // SIGINT
@@ -130,7 +153,7 @@ const usePyodideWorker = (callbacks: {
   onStderr: (data: string) => void;
   onStatus: (status: InterpreterStatus) => void;
   onData?: (data: any) => void;
-  onImage?: (image: string) => void;
+  onImage?: (image: PlotImage) => void;
 }) => {
   const [worker, setWorker] = useState<PyodideWorkerInterface | undefined>(
     undefined,
@@ -17,6 +17,8 @@ export type UserSettings = {
   };
   pedantic: boolean;
   togglePedantic: () => void;
+  compactDraws: boolean;
+  toggleCompactDraws: () => void;
   theme: ThemeSetting;
   toggleTheme: () => void;
   stanWasmServerUrl: string;
@@ -26,6 +28,8 @@ export type UserSettings = {
 export const UserSettingsContext = createContext<UserSettings>({
   pedantic: false,
   togglePedantic: () => {},
+  compactDraws: false,
+  toggleCompactDraws: () => {},
   theme: "light",
   toggleTheme: () => {},
   settingsWindow: {
@@ -19,6 +19,7 @@ import { setWarnPedantic } from "@SpComponents/FileEditor/stanLsp";
 
 const defaultSettings = {
   pedantic: false,
+  compactDraws: false,
   serverUrl: publicCompilationServerUrl,
 } as const;
 
@@ -34,8 +35,11 @@ const loadStoredSettings = () => {
   };
 };
 
-const { pedantic: defaultPedantic, serverUrl: defaultStanWasmServerUrl } =
-  loadStoredSettings();
+const {
+  pedantic: defaultPedantic,
+  compactDraws: defaultCompactDraws,
+  serverUrl: defaultStanWasmServerUrl,
+} = loadStoredSettings();
 setWarnPedantic(defaultPedantic);
 
 const UserSettingsProvider: FunctionComponent<PropsWithChildren> = ({
@@ -43,6 +47,8 @@ const UserSettingsProvider: FunctionComponent<PropsWithChildren> = ({
 }) => {
   const [settingsTab, setSettingsTab] = useState<SettingsTab>("compilation");
   const [pedantic, setPedantic] = useState<boolean>(defaultPedantic);
+  const [compactDraws, setCompactDraws] =
+    useState<boolean>(defaultCompactDraws);
 
   const [stanWasmServerUrl, setStanWasmServerUrl] = useState<string>(
     defaultStanWasmServerUrl,
@@ -54,10 +60,11 @@ const UserSettingsProvider: FunctionComponent<PropsWithChildren> = ({
       "settings",
       JSON.stringify({
         pedantic,
+        compactDraws,
         serverUrl: stanWasmServerUrl,
       }),
     );
-  }, [stanWasmServerUrl, pedantic]);
+  }, [stanWasmServerUrl, pedantic, compactDraws]);
 
   // ------------------- Settings window -------------------
   const {
@@ -83,6 +90,12 @@ const UserSettingsProvider: FunctionComponent<PropsWithChildren> = ({
     });
   }, []);
 
+  // ------------------- Compact draws -------------------
+
+  const toggleCompactDraws = useCallback(() => {
+    setCompactDraws((prev) => !prev);
+  }, []);
+
   // ------------------- Theme -------------------
   // defaults and storage handled by mui
   const { mode, setMode, systemMode } = useColorScheme();
@@ -109,6 +122,8 @@ const UserSettingsProvider: FunctionComponent<PropsWithChildren> = ({
         toggleTheme,
         pedantic,
         togglePedantic,
+        compactDraws,
+        toggleCompactDraws,
         stanWasmServerUrl,
         setStanWasmServerUrl,
       }}
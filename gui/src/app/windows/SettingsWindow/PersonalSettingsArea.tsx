@@ -13,8 +13,14 @@ import { UserSettingsContext } from "@SpCore/Settings/UserSettings";
 
 const PersonalSettingsArea: FunctionComponent = () => {
   const { update } = use(ProjectContext);
-  const { pedantic, togglePedantic, theme, toggleTheme } =
-    use(UserSettingsContext);
+  const {
+    pedantic,
+    togglePedantic,
+    compactDraws,
+    toggleCompactDraws,
+    theme,
+    toggleTheme,
+  } = use(UserSettingsContext);
 
   return (
     <div className="dialogWrapper">
@@ -61,6 +67,28 @@ const PersonalSettingsArea: FunctionComponent = () => {
         </FormHelperText>
       </FormControl>
 
+      <FormControl>
+        <FormLabel id="analysis-settings">
+          <h3>Analysis</h3>
+        </FormLabel>
+        <FormControlLabel
+          value="public"
+          control={
+            <Switch onClick={toggleCompactDraws} checked={compactDraws} />
+          }
+          label="Load draws in single precision"
+          aria-label="load draws in single precision"
+          title="Load draws in single precision"
+        />
+        <FormHelperText>
+          Loads the draws given to Python analysis scripts as 32-bit floats
+          rather than 64-bit ones, as if by <code>draws.compact()</code>. This
+          halves the memory they take, for runs too large to analyze otherwise,
+          but their values are less precise and data frames of them are
+          read-only.
+        </FormHelperText>
+      </FormControl>
+
       <FormControl>
         <FormLabel id="reset-settings">
           <h3>Reset to defaults</h3>
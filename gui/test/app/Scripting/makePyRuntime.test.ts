@@ -69,7 +69,17 @@ print(fit.summary())
 
 # Used in pyodideWorker for running analysis.py
 
-from typing import TYPE_CHECKING, List, TypedDict
+from typing import (
+    TYPE_CHECKING,
+    Dict,
+    List,
+    Literal,
+    Optional,
+    Set,
+    Tuple,
+    TypedDict,
+    Union,
+)
 
 import numpy as np
 import pandas as pd
@@ -81,67 +91,458 @@ if TYPE_CHECKING:
     from arviz import InferenceData
 
 
-class SpData(TypedDict):
-    draws: List[List[float]]
+class _SpDataRequired(TypedDict):
+    # either num_params lists of (num_chains * num_draws) values, or a buffer
+    # of values of type drawsDtype in the shape given by drawsShape
+    draws: Union[List[List[float]], memoryview]
     paramNames: List[str]
     numChains: int
 
 
+class SpData(_SpDataRequired, total=False):
+    # (num_chains, num_draws, num_params), if draws is a buffer
+    drawsShape: Tuple[int, int, int]
+    # float32 for draws which are loaded compact, see DrawsObject.compact
+    drawsDtype: Literal["float64", "float32"]
+    # identifies the sampling run the draws come from, see sp_load_draws
+    runId: int
+
+
+def _draws_array(sp_data: SpData) -> np.ndarray:
+    dtype = np.dtype(sp_data.get("drawsDtype", "float64"))
+    shape = sp_data.get("drawsShape")
+    if shape is not None:
+        draws = sp_data["draws"]
+        if hasattr(draws, "to_memoryview"):
+            # a typed array that pyodide left in JavaScript
+            draws = draws.to_memoryview()
+        # a view of the buffer, which is already in the right layout
+        return np.frombuffer(draws, dtype=dtype).reshape(shape)
+
+    # draws come in as num_params by (num_chains * num_draws)
+    return (
+        np.array(sp_data["draws"], dtype=dtype)
+        .transpose()
+        .reshape(sp_data["numChains"], -1, len(sp_data["paramNames"]))
+    )
+
+
+def _copy_on_write() -> bool:
+    # always the case from pandas 3, and optional before
+    return (
+        int(pd.__version__.split(".")[0]) >= 3 or pd.options.mode.copy_on_write is True
+    )
+
+
+def _read_only(array: np.ndarray) -> np.ndarray:
+    view = array.view()
+    view.flags.writeable = False
+    return view
+
+
+# Posterior diagnostics, following Vehtari et al. (2021), "Rank-normalization,
+# folding, and localization: An improved R-hat for assessing convergence of
+# MCMC", as implemented by Stan, posterior, and arviz. These use only numpy,
+# and work on many parameters at once, given as a (param, chain, draw) array.
+
+
+_SUMMARY_COLUMNS = [
+    "mean",
+    "mcse_mean",
+    "sd",
+    "5%",
+    "50%",
+    "95%",
+    "ess_bulk",
+    "ess_tail",
+    "r_hat",
+]
+
+# the number of draws summarized at once, see DrawsObject.summary
+_SUMMARY_BLOCK_VALUES = 1 << 20
+
+
+def _split_chains(x: np.ndarray) -> np.ndarray:
+    # each chain becomes two, dropping the middle draw of odd lengths
+    half = x.shape[2] // 2
+    return np.concatenate((x[:, :, :half], x[:, :, x.shape[2] - half :]), axis=1)
+
+
+def _inverse_normal_cdf(p: np.ndarray) -> np.ndarray:
+    # Acklam's rational approximation, with a relative error below 1.2e-9
+    a = (
+        -39.69683028665376,
+        220.9460984245205,
+        -275.9285104469687,
+        138.3577518672690,
+        -30.66479806614716,
+        2.506628277459239,
+    )
+    b = (
+        -54.47609879822406,
+        161.5858368580409,
+        -155.6989798598866,
+        66.80131188771972,
+        -13.28068155288572,
+        1,
+    )
+    c = (
+        -0.007784894002430293,
+        -0.3223964580411365,
+        -2.400758277161838,
+        -2.549732539343734,
+        4.374664141464968,
+        2.938163982698783,
+    )
+    d = (
+        0.007784695709041462,
+        0.3224671290700398,
+        2.445134137142996,
+        3.754408661907416,
+        1,
+    )
+
+    q = p - 0.5
+    r = q * q
+    z = q * np.polyval(a, r) / np.polyval(b, r)
+    low = p < 0.02425
+    t = np.sqrt(-2 * np.log(p[low]))
+    z[low] = np.polyval(c, t) / np.polyval(d, t)
+    high = p > 1 - 0.02425
+    t = np.sqrt(-2 * np.log1p(-p[high]))
+    z[high] = -np.polyval(c, t) / np.polyval(d, t)
+    return z
+
+
+def _rank_normalize(x: np.ndarray) -> np.ndarray:
+    # normal scores of the ranks of the draws of all chains together,
+    # with tied draws sharing their average rank
+    flat = x.reshape(x.shape[0], -1)
+    size = flat.shape[1]
+
+    order = np.argsort(flat, axis=1)
+    ordered = np.take_along_axis(flat, order, axis=1)
+    positions = np.broadcast_to(np.arange(1, size + 1), flat.shape)
+
+    starts_tie = np.ones(flat.shape, dtype=bool)
+    starts_tie[:, 1:] = ordered[:, 1:] != ordered[:, :-1]
+    ends_tie = np.ones(flat.shape, dtype=bool)
+    ends_tie[:, :-1] = starts_tie[:, 1:]
+    first = np.maximum.accumulate(np.where(starts_tie, positions, 0), axis=1)
+    reversed_ends = np.where(ends_tie, positions, size + 1)[:, ::-1]
+    last = np.minimum.accumulate(reversed_ends, axis=1)[:, ::-1]
+
+    # average ranks are multiples of 1/2, so the scores of all the
+    # possible ranks are computed once and looked up
+    doubled_ranks = np.arange(2 * size + 1)
+    scores = _inverse_normal_cdf((doubled_ranks[2:] / 2 - 0.375) / (size + 0.25))
+    normalized = np.empty(flat.shape)
+    np.put_along_axis(normalized, order, scores[first + last - 2], axis=1)
+    return normalized.reshape(x.shape)
+
+
+def _rhat(x: np.ndarray) -> np.ndarray:
+    num_draws = x.shape[2]
+    between = num_draws * x.mean(axis=2).var(axis=1, ddof=1)
+    within = x.var(axis=2, ddof=1).mean(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.sqrt(
+            ((num_draws - 1) / num_draws * within + between / num_draws) / within
+        )
+
+
+def _rank_normalized_rhat(split: np.ndarray, normalized: np.ndarray) -> np.ndarray:
+    bulk = _rhat(normalized)
+    median = np.median(split.reshape(split.shape[0], -1), axis=1)
+    tail = _rhat(_rank_normalize(np.abs(split - median[:, None, None])))
+    return np.maximum(bulk, tail)
+
+
+def _autocovariance(x: np.ndarray) -> np.ndarray:
+    # of each chain, through the FFT, zero padded to avoid circular overlap
+    num_draws = x.shape[2]
+    size = 1 << (2 * num_draws - 1).bit_length()
+    centered = x - x.mean(axis=2, keepdims=True)
+    spectrum = np.fft.rfft(centered, n=size, axis=2)
+    acov = np.fft.irfft(spectrum.real**2 + spectrum.imag**2, n=size, axis=2)
+    return acov[:, :, :num_draws] / num_draws
+
+
+def _ess(x: np.ndarray) -> np.ndarray:
+    (num_params, num_chains, num_draws) = x.shape
+    acov = _autocovariance(x)
+    mean_var = acov[:, :, 0].mean(axis=1) * num_draws / (num_draws - 1)
+    var_plus = mean_var * (num_draws - 1) / num_draws
+    if num_chains > 1:
+        var_plus = var_plus + x.mean(axis=2).var(axis=1, ddof=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rho = 1 - (mean_var[:, None] - acov.mean(axis=1)) / var_plus[:, None]
+    rho[:, 0] = 1
+
+    # Geyer's initial positive sequence: consecutive pairs of autocorrelations
+    # are summed, up to the first pair (at most last_pair) whose sum is not
+    # positive. Those sums are then made monotone (the initial monotone sequence)
+    last_pair = max((num_draws - 3) // 2, 0)
+    pairs = rho[:, 0 : 2 * last_pair + 2 : 2] + rho[:, 1 : 2 * last_pair + 2 : 2]
+    num_positive = np.cumprod(pairs > 0, axis=1).sum(axis=1)
+    last = np.minimum(num_positive, last_pair)
+    before_last = np.arange(last_pair + 1) < last[:, None]
+    total = np.where(before_last, np.minimum.accumulate(pairs, axis=1), 0).sum(axis=1)
+
+    # the first autocorrelation of the last pair is kept if the pair is,
+    # or if it is positive
+    params = np.arange(num_params)
+    last_even = rho[params, 2 * last]
+    keep_last_even = (pairs[params, last] >= 0) | (last_even > 0)
+    tau = -1 + 2 * total + np.where(keep_last_even, last_even, 0)
+
+    size = num_chains * num_draws
+    tau = np.maximum(tau, 1 / np.log10(size))
+    # constant draws have no meaningful effective sample size
+    return np.where(var_plus > 0, size / tau, np.nan)
+
+
+def _summarize(draws: np.ndarray) -> Dict[str, np.ndarray]:
+    # the diagnostics work with the draws of each parameter next to each other,
+    # in double precision even if the draws are compact
+    x = np.ascontiguousarray(draws.transpose(2, 0, 1), dtype=np.float64)
+    num_params = x.shape[0]
+    flat = x.reshape(num_params, -1)
+
+    sd = flat.std(axis=1, ddof=1)
+    (q5, q50, q95) = np.quantile(flat, [0.05, 0.5, 0.95], axis=1)
+    summary = {
+        "mean": flat.mean(axis=1),
+        "mcse_mean": np.full(num_params, np.nan),
+        "sd": sd,
+        "5%": q5,
+        "50%": q50,
+        "95%": q95,
+        "ess_bulk": np.full(num_params, np.nan),
+        "ess_tail": np.full(num_params, np.nan),
+        "r_hat": np.full(num_params, np.nan),
+    }
+    if x.shape[2] < 4:
+        return summary
+
+    split = _split_chains(x)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        summary["mcse_mean"] = sd / np.sqrt(_ess(split))
+    normalized = _rank_normalize(split)
+    summary["ess_bulk"] = _ess(normalized)
+    summary["ess_tail"] = np.minimum(
+        _ess(_split_chains((x <= q5[:, None, None]).astype(np.float64))),
+        _ess(_split_chains((x <= q95[:, None, None]).astype(np.float64))),
+    )
+    summary["r_hat"] = _rank_normalized_rhat(split, normalized)
+
+    # the diagnostics are not defined for draws which are not all finite
+    finite = np.isfinite(flat).all(axis=1)
+    for name in ("mcse_mean", "ess_bulk", "ess_tail", "r_hat"):
+        summary[name] = np.where(finite, summary[name], np.nan)
+    return summary
+
+
 class DrawsObject:
-    def __init__(self, sp_data: SpData):
+    def __init__(self, sp_data: SpData, draws: Optional[np.ndarray] = None):
+        # draws, if given, are those of sp_data already loaded as a
+        # read-only array, see sp_load_draws
 
         self._all_parameter_names: List[str] = sp_data["paramNames"]
+        # compact may leave out some of the parameters
+        self._excluded: Set[str] = set()
 
         self._params = stanio.parse_header(",".join(self._all_parameter_names))
 
         self._num_chains: int = sp_data["numChains"]
 
-        # draws come in as num_params by (num_chains * num_draws)
-        self._draws = (
-            np.array(sp_data["draws"])
-            .transpose()
-            .reshape(self._num_chains, -1, len(self._all_parameter_names))
-        )
+        # the accessors below return views of the draws and cache their
+        # results, so nothing may change them
+        self._draws = _read_only(_draws_array(sp_data)) if draws is None else draws
+        self._compact = self._draws.dtype == np.float32
+
+        self._extracted: Dict[str, np.ndarray] = {}
+        self._dataframes: Dict[Optional[Tuple[str, ...]], pd.DataFrame] = {}
+        self._summaries: Dict[Optional[Tuple[str, ...]], pd.DataFrame] = {}
 
     def __repr__(self) -> str:
         return f"""SpDraws with {self._num_chains} chains, {self._draws.shape[1]} draws, and {self._draws.shape[2]} parameters.
         Methods:
-        - as_dataframe(): return a pandas DataFrame of the draws.
-        - as_numpy(): return a numpy array indexed by (chain, draw, parameter)
-        - as_arviz(): return an arviz InferenceData object
-        - get(pname: str): return a numpy array of the parameter values for the given parameter name"""
+        - compact(exclude=None): return the draws stored as float32 to halve their memory, optionally without some parameters such as lp__
+        - as_dataframe(parameters=None): return a pandas DataFrame of the draws, optionally of only some parameters.
+        - as_numpy(): return a read-only numpy array indexed by (chain, draw, parameter)
+        - summary(parameters=None): return a pandas DataFrame of posterior summaries and diagnostics (R-hat, ESS, MCSE), optionally of only some parameters
+        - to_arviz(parameters=None): return an arviz InferenceData object, optionally of only some parameters
+        - get(pname: str): return a read-only numpy array of the parameter values for the given parameter name"""
+
+    def _check_parameter(self, pname: str) -> stanio.Variable:
+        if pname not in self._params:
+            raise ValueError(f"Parameter {pname} not found")
+        return self._params[pname]
+
+    def compact(self, exclude: Optional[List[str]] = None) -> "DrawsObject":
+        # Returns the draws stored as float32 rather than float64, for fits too
+        # large to analyze otherwise, optionally without the given parameters
+        # (such as lp__, or sampler diagnostics like treedepth__). Data frames
+        # of these draws share their values rather than copying them, so those
+        # values are read-only, and have integer chain and draw columns.
+        #
+        # This object is unchanged, and holding both takes more memory than
+        # either. The draws can instead be loaded as float32 in the first place
+        # (with the setting to load draws in single precision), in which case
+        # only excluding parameters copies them
+
+        exclude = [pname for pname in exclude or [] if pname not in self._excluded]
+        excluded_columns = {
+            i for pname in exclude for i in self._check_parameter(pname).columns()
+        }
+        kept = [
+            i
+            for i in range(len(self._all_parameter_names))
+            if i not in excluded_columns
+        ]
+
+        if self._compact and not excluded_columns:
+            compacted = self._draws
+        else:
+            (num_chains, num_draws, _) = self._draws.shape
+            compacted = np.empty((num_chains, num_draws, len(kept)), dtype=np.float32)
+            # a chain at a time, so that little more memory than the draws
+            # themselves is needed
+            for chain in range(num_chains):
+                compacted[chain] = self._draws[chain][:, kept]
+            compacted = _read_only(compacted)
+
+        compact_draws = DrawsObject(
+            {
+                "draws": [],
+                "paramNames": [self._all_parameter_names[i] for i in kept],
+                "numChains": self._num_chains,
+            },
+            compacted,
+        )
+        compact_draws._excluded = self._excluded.union(exclude)
+        return compact_draws
 
-    def as_dataframe(self) -> pd.DataFrame:
+    def as_dataframe(self, parameters: Optional[List[str]] = None) -> pd.DataFrame:
         # The first column is the chain id
         # The second column is the draw number
-        # The remaining columns are the parameter values
-
+        # The remaining columns are the parameter values,
+        # for all parameters or only the given ones
+
+        if self._compact:
+            # not cached, since a copy would undo the saving. The values are
+            # those of the read-only draws, so changing them in place raises
+            # an error rather than changing the draws
+            return self._make_dataframe(parameters)
+
+        if not _copy_on_write():
+            # only a deep copy of a cached DataFrame would be safe to change,
+            # which costs as much as making it again and keeps another copy
+            # of the draws alive, so it is not cached
+            return self._make_dataframe(parameters)
+
+        key = None if parameters is None else tuple(parameters)
+        if key not in self._dataframes:
+            self._dataframes[key] = self._make_dataframe(parameters)
+        # with copy-on-write, changing the returned DataFrame in place copies
+        # what it changes, rather than changing the cached one
+        return self._dataframes[key].copy(deep=False)
+
+    def _make_dataframe(self, parameters: Optional[List[str]]) -> pd.DataFrame:
         (num_chains, num_draws, num_params) = self._draws.shape
         flattened = self._draws.reshape(-1, num_params)
 
+        if parameters is None:
+            columns = self._all_parameter_names
+        else:
+            indices = [
+                i
+                for pname in parameters
+                for i in self._check_parameter(pname).columns()
+            ]
+            flattened = flattened[:, indices]
+            columns = [self._all_parameter_names[i] for i in indices]
+
         chain_ids = np.repeat(np.arange(1, num_chains + 1), num_draws)
         draw_numbers = np.tile(np.arange(1, num_draws + 1), num_chains)
 
+        if self._compact:
+            # the values are those of the draws rather than a copy
+            df = pd.DataFrame(flattened, columns=columns, copy=False)
+            df.insert(0, "draw", draw_numbers)
+            df.insert(0, "chain", chain_ids)
+            return df
+
         data = np.column_stack((chain_ids, draw_numbers, flattened))
 
-        df = pd.DataFrame(data, columns=["chain", "draw"] + self._all_parameter_names)
+        df = pd.DataFrame(data, columns=["chain", "draw"] + columns)
         return df
 
+    def summary(self, parameters: Optional[List[str]] = None) -> pd.DataFrame:
+        # One row per column of the draws, for all parameters or only the
+        # given ones, with the posterior mean, its Monte Carlo standard error,
+        # the standard deviation, quantiles, bulk and tail effective sample
+        # sizes, and the rank normalized split R-hat.
+        #
+        # Like in Stan and posterior, the tail ESS is NaN for parameters which
+        # take few distinct values (such as discrete or binary ones) when the
+        # 95% quantile is their largest value: the indicator of the draws at or
+        # below it, whose ESS is the tail ESS, is then constant. arviz reports
+        # the number of draws instead. Diagnostics are also NaN with fewer than
+        # 4 draws per chain, or draws which are not all finite
+
+        key = None if parameters is None else tuple(parameters)
+        if key not in self._summaries:
+            self._summaries[key] = self._make_summary(parameters)
+        return self._summaries[key].copy()
+
+    def _make_summary(self, parameters: Optional[List[str]]) -> pd.DataFrame:
+        if parameters is None:
+            indices = list(range(len(self._all_parameter_names)))
+        else:
+            indices = [
+                i
+                for pname in parameters
+                for i in self._check_parameter(pname).columns()
+            ]
+
+        # summarized a block of columns at a time, so the memory used
+        # does not grow with the number of parameters
+        (num_chains, num_draws, _) = self._draws.shape
+        block_size = max(1, _SUMMARY_BLOCK_VALUES // (num_chains * num_draws))
+        blocks = [
+            _summarize(self._draws[:, :, indices[start : start + block_size]])
+            for start in range(0, len(indices), block_size)
+        ]
+
+        return pd.DataFrame(
+            {
+                column: np.concatenate([block[column] for block in blocks] or [[]])
+                for column in _SUMMARY_COLUMNS
+            },
+            index=pd.Index(
+                [self._all_parameter_names[i] for i in indices], name="parameter"
+            ),
+        )
+
     def as_numpy(self) -> np.ndarray:
-        return np.array(self._draws)
+        return self._draws.view()
 
     def get(self, pname: str) -> np.ndarray:
-        if pname not in self._params:
-            raise ValueError(f"Parameter {pname} not found")
-        return self._params[pname].extract_reshape(self._draws)
+        if pname not in self._extracted:
+            values = self._check_parameter(pname).extract_reshape(self._draws)
+            self._extracted[pname] = _read_only(values)
+        return self._extracted[pname]
 
-    def to_arviz(self) -> "InferenceData":
+    def to_arviz(self, parameters: Optional[List[str]] = None) -> "InferenceData":
         import arviz as az
 
+        if parameters is None:
+            parameters = self.parameter_names
+
         return az.from_dict(
-            data={
-                "posterior": {pname: self.get(pname) for pname in self.parameter_names}
-            },
+            data={"posterior": {pname: self.get(pname) for pname in parameters}},
         )
 
     @property
@@ -153,8 +554,29 @@ class DrawsObject:
         return list(self._all_parameter_names)
 
 
+# The draws of the latest sampling run, kept for as long as the interpreter,
+# so that rerunning the analysis of the same run does not load them again.
+# Only the read-only array is kept: each run of the analysis gets a DrawsObject
+# of its own, so nothing a script does to one (such as compact) can change
+# the results of the next
+_loaded_draws: Optional[Tuple[int, np.ndarray]] = None
+
+
+def _load_draws_array(sp_data: SpData) -> np.ndarray:
+    global _loaded_draws
+
+    run_id = sp_data.get("runId")
+    if run_id is None:
+        return _read_only(_draws_array(sp_data))
+    if _loaded_draws is None or _loaded_draws[0] != run_id:
+        # drop the previous draws first, so both are never held at once
+        _loaded_draws = None
+        _loaded_draws = (run_id, _read_only(_draws_array(sp_data)))
+    return _loaded_draws[1]
+
+
 def sp_load_draws(sp_data: SpData) -> DrawsObject:
-    return DrawsObject(sp_data)
+    return DrawsObject(sp_data, _load_draws_array(sp_data))
 
 import matplotlib.pyplot as plt
 
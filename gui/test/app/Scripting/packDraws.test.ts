@@ -0,0 +1,52 @@
+import packDraws from "@SpCore/Scripting/pyodide/packDraws";
+import { describe, expect, test } from "vitest";
+
+describe("packDraws", () => {
+  test("Draws are laid out by chain, draw, then parameter", () => {
+    // two chains of two draws each
+    const draws = [
+      [1, 2, 3, 4],
+      [10, 20, 30, 40],
+      [100, 200, 300, 400],
+    ];
+    const packed = packDraws({
+      draws,
+      paramNames: ["lp__", "a", "b"],
+      numChains: 2,
+    });
+
+    expect(packed.drawsShape).toStrictEqual([2, 2, 3]);
+    expect(Array.from(packed.draws)).toStrictEqual([
+      1, 10, 100, 2, 20, 200, 3, 30, 300, 4, 40, 400,
+    ]);
+    expect(packed.drawsDtype).toBe("float64");
+    expect(packed.draws).toBeInstanceOf(Float64Array);
+    expect(packed.paramNames).toStrictEqual(["lp__", "a", "b"]);
+    expect(packed.numChains).toBe(2);
+  });
+
+  test("Compact draws are packed as single precision floats", () => {
+    const draws = [
+      [1, 2, 3, 4],
+      [0.1, 0.2, 0.3, 0.4],
+    ];
+    const packed = packDraws(
+      { draws, paramNames: ["lp__", "a"], numChains: 2 },
+      { compact: true },
+    );
+
+    expect(packed.drawsDtype).toBe("float32");
+    expect(packed.draws).toBeInstanceOf(Float32Array);
+    expect(packed.drawsShape).toStrictEqual([2, 2, 2]);
+    expect(Array.from(packed.draws)).toStrictEqual(
+      [1, 0.1, 2, 0.2, 3, 0.3, 4, 0.4].map(Math.fround),
+    );
+  });
+
+  test("No draws gives an empty buffer", () => {
+    const packed = packDraws({ draws: [], paramNames: [], numChains: 4 });
+
+    expect(packed.drawsShape).toStrictEqual([4, 0, 0]);
+    expect(packed.draws.length).toBe(0);
+  });
+});
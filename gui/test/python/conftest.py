@@ -0,0 +1,7 @@
+import sys
+from pathlib import Path
+
+# the modules run in pyodide are plain Python files, not a package
+sys.path.insert(
+    0, str(Path(__file__).parents[2] / "src" / "app" / "core" / "Scripting" / "pyodide")
+)
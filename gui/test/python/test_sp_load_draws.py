@@ -0,0 +1,171 @@
+from contextlib import ExitStack, suppress
+from typing import List
+
+import numpy as np
+import pandas as pd
+from sp_load_draws import DrawsObject, SpData, sp_load_draws
+
+PARAM_NAMES = ["lp__", "mu", "theta.1", "theta.2"]
+
+
+def make_sp_data(num_chains: int = 2, num_draws: int = 10) -> SpData:
+    rng = np.random.default_rng(0)
+    draws: List[List[float]] = rng.normal(
+        size=(len(PARAM_NAMES), num_chains * num_draws)
+    ).tolist()
+    return {"draws": draws, "paramNames": PARAM_NAMES, "numChains": num_chains}
+
+
+def test_dataframe_changed_in_place_does_not_change_the_next() -> None:
+    draws = DrawsObject(make_sp_data())
+    expected = DrawsObject(make_sp_data()).as_dataframe(["mu"])
+
+    df = draws.as_dataframe(["mu"])
+    df.iloc[0, 2] = 1e6
+    df["mu"] *= 2
+
+    pd.testing.assert_frame_equal(draws.as_dataframe(["mu"]), expected)
+
+
+def test_dataframes_share_their_values_with_copy_on_write() -> None:
+    draws = DrawsObject(make_sp_data())
+
+    with ExitStack() as stack:
+        if int(pd.__version__.split(".")[0]) < 3:
+            stack.enter_context(pd.option_context("mode.copy_on_write", True))
+        first = draws.as_dataframe()
+        second = draws.as_dataframe()
+        assert np.shares_memory(first["mu"].to_numpy(), second["mu"].to_numpy())
+
+        second.iloc[0, 2] = 1e6
+
+        assert first.iloc[0, 2] != 1e6
+
+
+def test_compact_dataframe_changed_in_place_does_not_change_the_next() -> None:
+    draws = DrawsObject(make_sp_data()).compact()
+    expected = DrawsObject(make_sp_data()).compact().as_dataframe()
+
+    df = draws.as_dataframe()
+    # the values are read-only, unless pandas copies them on write
+    with suppress(ValueError):
+        df.iloc[0, 2] = 1e6
+    with suppress(ValueError):
+        df["mu"] *= 2
+
+    pd.testing.assert_frame_equal(draws.as_dataframe(), expected)
+
+
+def test_summary_changed_in_place_does_not_change_the_next() -> None:
+    draws = DrawsObject(make_sp_data())
+    expected = DrawsObject(make_sp_data()).summary()
+
+    summary = draws.summary()
+    summary.iloc[0, 0] = 1e6
+    summary["r_hat"] *= 2
+
+    pd.testing.assert_frame_equal(draws.summary(), expected)
+
+
+def test_compact_returns_new_draws() -> None:
+    draws = DrawsObject(make_sp_data())
+
+    compact = draws.compact(exclude=["lp__"])
+
+    assert compact.raw_parameter_names == PARAM_NAMES[1:]
+    assert compact.as_numpy().dtype == np.float32
+    np.testing.assert_allclose(
+        compact.as_numpy(), draws.as_numpy()[:, :, 1:], rtol=1e-6
+    )
+    assert draws.raw_parameter_names == PARAM_NAMES
+    assert draws.as_numpy().dtype == np.float64
+
+
+def test_draws_loaded_compact() -> None:
+    # as packed by packDraws with the compact option
+    values = np.arange(2 * 3 * 4, dtype=np.float32)
+    draws = DrawsObject(
+        {
+            "draws": memoryview(values),
+            "drawsShape": (2, 3, 4),
+            "drawsDtype": "float32",
+            "paramNames": PARAM_NAMES,
+            "numChains": 2,
+        }
+    )
+
+    assert draws.as_numpy().dtype == np.float32
+    np.testing.assert_array_equal(draws.get("mu"), [[1, 5, 9], [13, 17, 21]])
+    # already compact, so the draws are not copied again
+    assert np.shares_memory(draws.compact().as_numpy(), draws.as_numpy())
+
+
+def test_load_draws_of_the_same_run_again() -> None:
+    sp_data = make_sp_data()
+    sp_data["runId"] = 1
+    first = sp_load_draws(sp_data)
+    first.compact(exclude=["lp__"])
+
+    second = sp_load_draws(sp_data)
+
+    # the array is loaded once, but not the changes made to the first object
+    assert second is not first
+    assert second.raw_parameter_names == PARAM_NAMES
+    assert second.as_numpy().dtype == np.float64
+    assert np.shares_memory(sp_load_draws(sp_data).as_numpy(), second.as_numpy())
+
+
+def make_diagnostics_draws() -> np.ndarray:
+    # (chain, draw, param): independent draws, autocorrelated draws,
+    # and draws whose chains have different means
+    rng = np.random.default_rng(1234)
+    independent = rng.normal(size=(4, 100))
+    autocorrelated = np.zeros((4, 100))
+    noise = rng.normal(size=(4, 100))
+    for t in range(1, 100):
+        autocorrelated[:, t] = 0.9 * autocorrelated[:, t - 1] + noise[:, t]
+    shifted = rng.normal(size=(4, 100)) + 0.5 * np.arange(4)[:, None]
+    return np.stack([independent, autocorrelated, shifted], axis=2)
+
+
+# computed with arviz 0.23 (ess with method="bulk" and "tail",
+# rhat with method="rank", and mcse with method="mean")
+ARVIZ_DIAGNOSTICS = {
+    "ess_bulk": [374.4906413323418, 37.48389000248371, 14.565333897471275],
+    "ess_tail": [415.80230543852525, 99.83380887424872, 147.12292938099384],
+    "r_hat": [1.002452420203776, 1.0969384904446056, 1.2218652548458153],
+    "mcse_mean": [0.05333763938435114, 0.3016447362675524, 0.2997302020115585],
+}
+
+
+def test_summary_matches_arviz() -> None:
+    x = make_diagnostics_draws()
+    draws = DrawsObject(
+        {
+            "draws": x.transpose(2, 0, 1).reshape(3, -1).tolist(),
+            "paramNames": ["a", "b", "c"],
+            "numChains": 4,
+        }
+    )
+
+    summary = draws.summary()
+
+    flat = x.reshape(-1, 3)
+    np.testing.assert_allclose(summary["mean"], flat.mean(axis=0))
+    np.testing.assert_allclose(summary["sd"], flat.std(axis=0, ddof=1))
+    np.testing.assert_allclose(summary["95%"], np.quantile(flat, 0.95, axis=0))
+    for column, expected in ARVIZ_DIAGNOSTICS.items():
+        np.testing.assert_allclose(summary[column], expected, rtol=1e-6)
+
+
+def test_summary_of_binary_parameter_has_no_tail_ess() -> None:
+    values = np.random.default_rng(5).integers(0, 2, size=400).astype(float)
+    draws = DrawsObject(
+        {"draws": [values.tolist()], "paramNames": ["k"], "numChains": 4}
+    )
+
+    summary = draws.summary()
+
+    # every draw is at most the 95% quantile of 1
+    assert np.isnan(summary.loc["k", "ess_tail"])
+    assert np.isfinite(summary.loc["k", "ess_bulk"])